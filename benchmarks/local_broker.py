@@ -0,0 +1,152 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process stand-in for the part of amqpy used by the AMQP driver.
+
+Messages are routed by a broker object of the process and delivered
+through an eventlet queue per connection, so the AMQP driver can be
+benchmarked without RabbitMQ. It measures the driver, not a broker.
+"""
+
+import itertools
+from eventlet import queue
+
+
+class ChannelError(Exception):
+    pass
+
+
+class NotFound(ChannelError):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+class Message(object):
+    def __init__(self, body='', channel=None, **properties):
+        self.body = body
+        self.channel = channel
+        self.properties = properties
+        self.delivery_info = {}
+
+    @property
+    def delivery_tag(self):
+        return self.delivery_info.get('delivery_tag')
+
+
+class Broker(object):
+    def __init__(self):
+        self.queues = {}
+        self.consumers = {}
+        self.exchanges = {}
+        self.tags = itertools.count(1)
+
+    def route(self, msg, exchange, routing_key):
+        if not exchange:
+            targets = [routing_key] if routing_key in self.queues else []
+        else:
+            targets = list(self.exchanges[exchange])
+        for name in targets:
+            self.deliver(name, msg)
+
+    def deliver(self, name, msg):
+        consumers = self.consumers.get(name)
+        if not consumers:
+            self.queues[name].append(msg)
+            return
+        # Round robin between consumers
+        consumers.append(consumers.pop(0))
+        channel, tag, callback = consumers[-1]
+        delivered = Message(msg.body, channel, **msg.properties)
+        delivered.delivery_info = {'delivery_tag': next(self.tags)}
+        channel.connection.incoming.put((callback, delivered))
+
+
+BROKER = Broker()
+
+
+class Channel(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        for name, consumers in BROKER.consumers.items():
+            BROKER.consumers[name] = [c for c in consumers if c[0] is not self]
+
+    def queue_declare(self, queue='', passive=False, exclusive=False, **kw):
+        if passive:
+            if queue not in BROKER.queues:
+                self.is_open = False
+                raise NotFound(queue)
+            return
+        BROKER.queues.setdefault(queue, [])
+
+    def queue_delete(self, queue):
+        BROKER.queues.pop(queue, None)
+        BROKER.consumers.pop(queue, None)
+
+    def exchange_declare(self, exchange, exch_type, **kw):
+        BROKER.exchanges[exchange] = set()
+
+    def exchange_delete(self, exchange):
+        BROKER.exchanges.pop(exchange, None)
+
+    def queue_bind(self, queue, exchange='', routing_key=''):
+        if queue not in BROKER.queues:
+            raise NotFound(queue)
+        BROKER.exchanges[exchange].add(queue)
+
+    def basic_consume(self, queue='', callback=None, **kw):
+        tag = 'tag{0}'.format(next(BROKER.tags))
+        BROKER.consumers.setdefault(queue, []).append((self, tag, callback))
+        pending, BROKER.queues[queue] = BROKER.queues.get(queue, []), []
+        for msg in pending:
+            BROKER.deliver(queue, msg)
+        return tag
+
+    def basic_cancel(self, tag):
+        for name, consumers in BROKER.consumers.items():
+            BROKER.consumers[name] = [c for c in consumers if c[1] != tag]
+
+    def basic_publish(self, msg, exchange='', routing_key='', **kw):
+        BROKER.route(msg, exchange, routing_key)
+
+    def basic_qos(self, *args, **kwargs):
+        pass
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+
+class Connection(object):
+    def __init__(self, **kw):
+        self.connected = True
+        self.incoming = queue.LightQueue()
+
+    def channel(self):
+        return Channel(self)
+
+    def drain_events(self, timeout=None):
+        try:
+            callback, msg = self.incoming.get(timeout=timeout)
+        except queue.Empty:
+            raise Timeout()
+        callback(msg)
+
+    def close(self):
+        self.connected = False
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Micro-benchmarks of dao.common hot paths.
+
+Usage:
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 0.1
+
+Every benchmark is timed in rounds of a calibrated number of operations,
+the best round gives the time per operation. With --compare the exit
+code is 1 if a benchmark got slower than the baseline by more than the
+threshold. AMQP benchmarks use an in-process stand-in for the broker
+unless --broker rabbit is given.
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import eventlet  # noqa
+
+BENCHMARKS = collections.OrderedDict()
+
+PAYLOAD = {'function': 'deploy',
+           'args': ('server-01', 42),
+           'kwargs': {'hosts': [{'name': 'host{0}'.format(i),
+                                 'ip': '10.0.0.{0}'.format(i),
+                                 'tags': ['a', 'b'],
+                                 'up': True} for i in range(20)]}}
+
+
+def benchmark(name):
+    """Register `setup`, which returns the operation to time"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def _codec_benchmarks():
+    from dao.common.rpc_driver import codec
+    for name, data_codec in sorted(codec.CODECS.items()):
+        body = data_codec.dumps(PAYLOAD)
+        benchmark('codec.{0}.dumps'.format(name))(
+            lambda c=data_codec: lambda: c.dumps(PAYLOAD))
+        benchmark('codec.{0}.loads'.format(name))(
+            lambda c=data_codec, b=body: lambda: c.loads(b))
+
+
+@benchmark('cacheit.key.hashable')
+def cacheit_key_hashable():
+    from dao.common import utils
+    cache = utils.CacheIt(ignore_self=False)
+    return lambda: cache._key_from_args(('host', 42), {'force': True})
+
+
+@benchmark('cacheit.key.unhashable')
+def cacheit_key_unhashable():
+    from dao.common import utils
+    cache = utils.CacheIt(ignore_self=False)
+    return lambda: cache._key_from_args((['host', 'ip'],), {'opts': {1: 2}})
+
+
+@benchmark('cacheit.hit')
+def cacheit_hit():
+    from dao.common import utils
+
+    @utils.CacheIt(timeout=3600, ignore_self=False)
+    def cached(a, b):
+        return a + b
+    cached(1, 2)
+    return lambda: cached(1, 2)
+
+
+@benchmark('synchronized.call')
+def synchronized_call():
+    from dao.common import utils
+
+    @utils.Synchronized('benchmark')
+    def locked(a):
+        return a
+    return lambda: locked(1)
+
+
+@benchmark('config.lookup')
+def config_lookup():
+    from dao.common import config
+    conf = config.get_config()
+    return lambda: conf.rpc.driver
+
+
+@benchmark('amqp.encode_decode')
+def amqp_encode_decode():
+    from dao.common.rpc_driver import amqp
+    from dao.common.rpc_driver import codec
+    data_codec = codec.CODECS[amqp.LEGACY_CODEC]
+    return lambda: amqp.decode(amqp.encode(PAYLOAD, data_codec))
+
+
+_ports = iter(range(15700, 15800))
+
+
+def _rpc_call(driver, **rabbit):
+    from dao.common import config
+    from dao.common import rpc
+    conf = config.get_config()
+    conf.rpc['driver'] = driver
+    for key, value in rabbit.items():
+        conf.rabbit[key] = value
+
+    class Server(rpc.RPCServer):
+        def echo(self, data):
+            return data
+
+    server = Server(next(_ports))
+    eventlet.spawn_n(server.do_main)
+    eventlet.sleep(0)
+    api = rpc.RPCApi(server.url)
+    api.call('echo', PAYLOAD)
+    return lambda: api.call('echo', PAYLOAD)
+
+
+@benchmark('rpc.amqp.call')
+def rpc_amqp_call():
+    return _rpc_call('dao.common.rpc_driver.amqp', shared_reply_queue=False)
+
+
+@benchmark('rpc.amqp.call_shared')
+def rpc_amqp_call_shared():
+    return _rpc_call('dao.common.rpc_driver.amqp', shared_reply_queue=True)
+
+
+@benchmark('rpc.local.call')
+def rpc_local_call():
+    return _rpc_call('dao.common.rpc_driver.local')
+
+
+@benchmark('rpc.zmq.call')
+def rpc_zmq_call():
+    return _rpc_call('dao.common.rpc_driver.zmq')
+
+
+@benchmark('rpc.zmq_router.call')
+def rpc_zmq_router_call():
+    return _rpc_call('dao.common.rpc_driver.zmq_router')
+
+
+def measure(op, min_time, repeat):
+    """Best and median time per call of `op`, in microseconds"""
+    timer = timeit.Timer(op)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    rounds = sorted([elapsed] + timer.repeat(repeat - 1, number))
+    return {'usec': rounds[0] / number * 1e6,
+            'median_usec': rounds[len(rounds) // 2] / number * 1e6,
+            'number': number}
+
+
+def run(names, min_time, repeat):
+    results = collections.OrderedDict()
+    for name in names:
+        try:
+            op = BENCHMARKS[name]()
+        except ImportError, exc:
+            print '{0:<28} skipped: {1}'.format(name, exc)
+            continue
+        results[name] = result = measure(op, min_time, repeat)
+        print '{0:<28} {1:>12.3f} usec'.format(name, result['usec'])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print changes against `baseline`, return names of regressions"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['usec'] / baseline[name]['usec']
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print '{0:<28} {1:>12.3f} -> {2:>12.3f} usec {3:+7.1%}{4}'.format(
+            name, baseline[name]['usec'], result['usec'], ratio - 1,
+            '  REGRESSION' if regressed else '')
+    return regressions
+
+
+def setup(broker):
+    if broker == 'local':
+        import local_broker
+        sys.modules['amqpy'] = local_broker
+    from dao.common import config
+    config.setup('benchmark')
+    conf = config.get_config()
+    # Imported for their options
+    from dao.common import rpc  # noqa
+    from dao.common.rpc_driver import amqp  # noqa
+    if not conf.rpc.get('ip'):
+        conf.rpc['ip'] = '127.0.0.1'
+    _codec_benchmarks()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-k', '--filter', action='append', default=[],
+                        help='Run benchmarks whose name contains it')
+    parser.add_argument('-o', '--output', help='Save results as JSON')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Compare with results saved by --output')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown failing --compare, 0.1 is 10%%')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='Min duration of a round, in seconds')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of rounds')
+    parser.add_argument('--broker', choices=('local', 'rabbit'),
+                        default='local',
+                        help='Broker of AMQP benchmarks, rabbit uses the '
+                             '[rabbit] section of the configuration')
+    args = parser.parse_args()
+
+    setup(args.broker)
+    names = [name for name in BENCHMARKS
+             if not args.filter or any(f in name for f in args.filter)]
+    results = run(names, args.min_time, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'broker': args.broker,
+                       'results': results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print '{0} benchmark(s) regressed by more than {1:.0%}'.format(
+                len(regressions), args.threshold)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
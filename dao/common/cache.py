@@ -0,0 +1,232 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Storage backends for utils.CacheIt.
+
+Backends keep entries of the form (value, expires) per cached function,
+where `expires` is a timestamp or None for results which never expire.
+Expiration is decided by CacheIt, backends only drop expired entries when
+asked to purge them. A backend may be shared by many CacheIt instances,
+which count the entries dropped for their own functions.
+"""
+
+import collections
+import cPickle as pickle
+import hashlib
+import os
+import sqlite3
+import time
+from dao.common import config
+from dao.common import log
+
+opts = [
+    config.StrOpt('common', 'cache_path', default='/var/lib/dao/cache.db',
+                  help='SQLite file with results cached across processes'),
+    config.IntOpt('common', 'cache_lock_timeout', default=5,
+                  help='Max time to wait for a lock on the cache file'),
+]
+config.register(opts)
+CONF = config.get_config()
+
+logger = log.getLogger(__name__)
+
+
+class Backend(object):
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+
+    def get(self, f, key):
+        """Entry cached for call of `f`, None if there is no entry"""
+        raise NotImplementedError()
+
+    def set(self, f, key, entry):
+        """Number of entries of `f` evicted to make room for `entry`"""
+        raise NotImplementedError()
+
+    def delete(self, f, key):
+        raise NotImplementedError()
+
+    def purge(self, functions, expired):
+        """Drop entries of `functions` which expired before `expired`
+        timestamp, return their number"""
+        raise NotImplementedError()
+
+    def size(self, functions):
+        raise NotImplementedError()
+
+
+class MemoryBackend(Backend):
+    """Entries kept by the process, least recently used evicted first"""
+
+    def __init__(self, maxsize=None):
+        super(MemoryBackend, self).__init__(maxsize)
+        self.cache = collections.defaultdict(collections.OrderedDict)
+
+    def get(self, f, key):
+        entries = self.cache[f]
+        entry = entries.pop(key, None)
+        if entry is not None:
+            # Keep the most recently used last
+            entries[key] = entry
+        return entry
+
+    def set(self, f, key, entry):
+        entries = self.cache[f]
+        entries.pop(key, None)
+        entries[key] = entry
+        evicted = 0
+        if self.maxsize is not None:
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def delete(self, f, key):
+        self.cache[f].pop(key, None)
+
+    def purge(self, functions, expired):
+        purged = 0
+        for f in functions:
+            entries = self.cache[f]
+            for key, entry in entries.items():
+                if entry[1] is not None and entry[1] < expired:
+                    del entries[key]
+                    purged += 1
+        return purged
+
+    def size(self, functions):
+        return sum(len(self.cache[f]) for f in functions)
+
+
+class SQLiteBackend(Backend):
+    """Entries shared by the processes of a node through an SQLite file.
+
+    Functions are told apart by module, name and line of definition, so
+    methods of the same name in a module do not share results, and code
+    moved around starts with an empty cache. Values are pickled, so the
+    results of functions cached this way must be picklable. Reads do not
+    write, so `maxsize` evicts the oldest entries rather than the least
+    recently used ones. The file outlives the processes, which keeps the
+    cache warm across restarts.
+
+    Expired entries are purged for the functions of the purging CacheIt
+    only. Entries of functions no longer cached, or moved to another line,
+    and results cached without timeout stay in the file until it is
+    removed.
+
+    Every lookup, hits included, is a blocking query made by the calling
+    green thread, so the whole process waits while the file is locked by
+    a writer of another process, up to `[common] cache_lock_timeout`.
+    Cache this way results which are worth it.
+    """
+
+    def __init__(self, path=None, maxsize=None):
+        super(SQLiteBackend, self).__init__(maxsize)
+        self.path = path or CONF.common.cache_path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            db = sqlite3.connect(self.path,
+                                 timeout=CONF.common.cache_lock_timeout)
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                           'namespace TEXT, key TEXT, value BLOB, '
+                           'expires REAL, created REAL, '
+                           'PRIMARY KEY (namespace, key))')
+            self._db = db
+        return self._db
+
+    @staticmethod
+    def _namespace(f):
+        return '{0}.{1}:{2}'.format(f.__module__, f.__name__,
+                                    f.__code__.co_firstlineno)
+
+    @staticmethod
+    def _key(key):
+        return hashlib.sha1(pickle.dumps(key, 2)).hexdigest()
+
+    def get(self, f, key):
+        row = self.db.execute(
+            'SELECT value, expires FROM cache '
+            'WHERE namespace = ? AND key = ?',
+            (self._namespace(f), self._key(key))).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(str(row[0])), row[1]
+
+    def set(self, f, key, entry):
+        try:
+            value = sqlite3.Binary(pickle.dumps(entry[0], 2))
+        except Exception, exc:
+            logger.warning('Result of %s is not cached: %r', f.__name__, exc)
+            return 0
+        namespace = self._namespace(f)
+        with self.db as db:
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                       (namespace, self._key(key), value, entry[1],
+                        time.time()))
+            if self.maxsize is not None:
+                cursor = db.execute(
+                    'DELETE FROM cache WHERE namespace = ? AND key IN ('
+                    'SELECT key FROM cache WHERE namespace = ? '
+                    'ORDER BY created DESC LIMIT -1 OFFSET ?)',
+                    (namespace, namespace, self.maxsize))
+                return cursor.rowcount
+        return 0
+
+    def delete(self, f, key):
+        with self.db as db:
+            db.execute('DELETE FROM cache WHERE namespace = ? AND key = ?',
+                       (self._namespace(f), self._key(key)))
+
+    def _namespaces(self, functions):
+        """SQL list of the namespaces of `functions` and its parameters"""
+        namespaces = [self._namespace(f) for f in functions]
+        return ', '.join('?' * len(namespaces)), namespaces
+
+    def purge(self, functions, expired):
+        sql, namespaces = self._namespaces(functions)
+        with self.db as db:
+            cursor = db.execute(
+                'DELETE FROM cache WHERE namespace IN ({0}) '
+                'AND expires < ?'.format(sql), namespaces + [expired])
+            return cursor.rowcount
+
+    def size(self, functions):
+        sql, namespaces = self._namespaces(functions)
+        return self.db.execute(
+            'SELECT COUNT(*) FROM cache WHERE namespace IN ({0})'.format(sql),
+            namespaces).fetchone()[0]
+
+
+_shared = {}
+
+
+def shared(path=None, maxsize=None):
+    """SQLite backend of the process for the file at `path`.
+
+    Backends are shared by the callers asking for the same `maxsize`,
+    which is enforced per cached function.
+    """
+    path = path or CONF.common.cache_path
+    backend = _shared.get((path, maxsize))
+    if backend is None:
+        backend = _shared[path, maxsize] = SQLiteBackend(path, maxsize)
+    return backend
@@ -67,6 +67,12 @@ class IntOpt(ConfOpt):
         return int(value)
 
 
+class FloatOpt(ConfOpt):
+
+    def _get_value(self, value):
+        return float(value)
+
+
 class NamedList(dict):
     def __getattr__(self, item):
         return self[item]
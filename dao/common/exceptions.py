@@ -32,6 +32,10 @@ class DAOTimeout(DAOException):
     pass
 
 
+class DAOServerBusy(DAOException):
+    pass
+
+
 class DAONotFound(DAOException):
     pass
 
@@ -0,0 +1,187 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process metrics: counters, gauges and latency histograms.
+
+Metrics live in a registry of the process and are looked up by name, e.g.
+`metrics.counter('rpc.server.deploy.calls').inc()`. A snapshot of all of
+them is served by the `_stats` RPC method and may be dumped to a file,
+periodically if `[common] metrics_interval` is set.
+"""
+
+import bisect
+import contextlib
+import eventlet
+import json
+import os
+import time
+import traceback
+from dao.common import config
+from dao.common import log
+
+opts = [
+    config.StrOpt('common', 'metrics_path', default='',
+                  help='File the metrics are dumped to, as JSON'),
+    config.IntOpt('common', 'metrics_interval', default=0,
+                  help='Seconds between dumps of the metrics, '
+                       '0 disables periodic dumps'),
+]
+config.register(opts)
+CONF = config.get_config()
+
+logger = log.getLogger(__name__)
+
+# Upper bounds of latency buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value set by its owner, or read from `func` on every snapshot"""
+
+    def __init__(self, func=None):
+        self.func = func
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.func is not None:
+            return self.func()
+        return self.value
+
+
+class Histogram(object):
+    """Distribution of values over fixed buckets.
+
+    Percentiles are estimated by the upper bound of the bucket they fall
+    in, which keeps recording cheap whatever the number of values is.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99)}
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, name, cls, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(*args)
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name, func=None):
+        gauge = self._get(name, Gauge)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    def snapshot(self):
+        return dict((name, metric.snapshot())
+                    for name, metric in self.metrics.items())
+
+    def dump(self, path=None):
+        """Write the snapshot to `path`, replacing the file atomically"""
+        path = path or CONF.common.metrics_path
+        data = {'time': time.time(),
+                'pid': os.getpid(),
+                'metrics': self.snapshot()}
+        tmp_path = '{0}.{1}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+snapshot = REGISTRY.snapshot
+dump = REGISTRY.dump
+
+_dumper = None
+
+
+def _dump_forever(interval):
+    while True:
+        eventlet.sleep(interval)
+        try:
+            dump()
+        except Exception:
+            logger.warning(traceback.format_exc())
+
+
+def start_dumps():
+    """Dump metrics every `[common] metrics_interval` seconds, if set"""
+    global _dumper
+    interval = CONF.common.metrics_interval
+    if _dumper is None and interval and CONF.common.metrics_path:
+        _dumper = eventlet.spawn(_dump_forever, interval)
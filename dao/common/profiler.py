@@ -0,0 +1,119 @@
+# Copyright 2016 Symantec, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Sampling profiler of RPC handlers.
+
+A share of requests, `[rpc] profile_sample_rate`, or every request of a
+method for a while is run under cProfile. Stats are aggregated per method
+and written to `<profile_dir>/<method>.prof`, to be read with pstats or
+any tool reading its format.
+
+cProfile sees every green thread switched to while a request runs, so
+only one request is profiled at a time and the stats of busy servers
+include some time of concurrent requests.
+"""
+
+import cProfile
+import os
+import pstats
+import random
+import re
+import time
+from dao.common import config
+from dao.common import exceptions
+from dao.common import log
+from dao.common import utils
+
+opts = [
+    config.FloatOpt('rpc', 'profile_sample_rate', default=0.0,
+                    help='Share of RPC requests to profile, 0 to 1'),
+    config.StrOpt('rpc', 'profile_dir', default='/var/lib/dao/profiles',
+                  help='Directory the profiles of RPC methods are saved to'),
+]
+config.register(opts)
+CONF = config.get_config()
+
+logger = log.getLogger(__name__)
+
+# Names of the methods profiled, which are file names as well
+NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+@utils.singleton
+class Profiler(object):
+    def __init__(self):
+        self.sample_rate = CONF.rpc.profile_sample_rate
+        self.stats = {}
+        # Method name to the time its profiling ends
+        self.targets = {}
+        self.active = False
+
+    def enable(self, func_name, seconds):
+        """Profile every request of `func_name` for `seconds`"""
+        self._check(func_name)
+        if seconds:
+            self.targets[func_name] = time.time() + seconds
+        else:
+            self.targets.pop(func_name, None)
+
+    @staticmethod
+    def _check(func_name):
+        if not NAME_RE.match(func_name):
+            raise exceptions.DAOException('Invalid method name: {0!r}'.
+                                          format(func_name))
+
+    def _sampled(self, func_name):
+        if self.active or not NAME_RE.match(func_name):
+            return False
+        until = self.targets.get(func_name)
+        if until is not None:
+            if until > time.time():
+                return True
+            del self.targets[func_name]
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def run(self, func_name, func, *args):
+        if not self._sampled(func_name):
+            return func(*args)
+        profile = cProfile.Profile()
+        self.active = True
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self.active = False
+            self._save(func_name, profile)
+
+    def _save(self, func_name, profile):
+        stats = self.stats.get(func_name)
+        if stats is None:
+            stats = self.stats[func_name] = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+        try:
+            self._check(func_name)
+            if not os.path.isdir(CONF.rpc.profile_dir):
+                os.makedirs(CONF.rpc.profile_dir)
+            stats.dump_stats(os.path.join(CONF.rpc.profile_dir,
+                                          func_name + '.prof'))
+        except Exception, exc:
+            logger.warning('Profile of %s is not saved: %r', func_name, exc)
+
+    def status(self):
+        now = time.time()
+        return {'sample_rate': self.sample_rate,
+                'targets': dict((name, until - now)
+                                for name, until in self.targets.items()
+                                if until > now),
+                'profiled': dict((name, stats.total_calls)
+                                 for name, stats in self.stats.items())}
@@ -13,12 +13,36 @@
 # under the License.
 
 import eventlet
+import inspect
+import time
 import traceback
+from eventlet import event
+from eventlet import queue
+from eventlet import semaphore
 from dao.common import config
+from dao.common import exceptions
 from dao.common import log
+from dao.common import metrics
+from dao.common import profiler
 from dao.common.rpc_driver import base as rpc_base
 
 
+opts = [
+    config.IntOpt('rpc', 'pool_size', default=10000,
+                  help='Max number of requests served at the same time'),
+    config.JSONOpt('rpc', 'bulkheads', default={},
+                   help='Concurrency limits of method groups, e.g. '
+                        '{"slow": {"methods": ["deploy"], '
+                        '"size": 10, "queue": 100}}'),
+    config.IntOpt('rpc', 'fanout_parallelism', default=100,
+                  help='Max number of servers FanOut calls at the same time'),
+    config.IntOpt('rpc', 'stream_chunk_size', default=100,
+                  help='Number of items per chunk of a streamed reply'),
+    config.IntOpt('rpc', 'stream_window', default=8,
+                  help='Max number of chunks of a stream sent ahead of '
+                       'the client'),
+]
+config.register(opts)
 CONF = config.get_config()
 LOG = log.getLogger(__name__)
 
@@ -41,47 +65,458 @@ class RPCApi(object):
             rpc_base.Client.get_backend(connect_url, ip, port, timeout)
 
     def call(self, func, *args, **kwargs):
-        self.backend.call(func, *args, **kwargs)
+        metrics.counter('rpc.client.{0}.calls'.format(func)).inc()
+        errors = metrics.counter('rpc.client.{0}.errors'.format(func))
+        with metrics.histogram('rpc.client.{0}.latency'.format(func)).time():
+            try:
+                response = self.backend.call(func, *args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+        if isinstance(response, Exception):
+            errors.inc()
+        return response
+
+    def call_async(self, func, *args, **kwargs):
+        """Make a call in a green thread of its own.
+
+        :return: RPCFuture with the result of the call
+        """
+        return RPCFuture(self.call, func, *args, **kwargs)
 
     def send(self, func, *args, **kwargs):
         self.backend.send(func, *args, **kwargs)
 
+    def call_stream(self, func, *args, **kwargs):
+        """Call a method whose result is sent in chunks.
+
+        The method returns an iterable, e.g. a generator, which the server
+        sends in chunks of `[rpc] stream_chunk_size` items, at most
+        `[rpc] stream_window` chunks ahead of the items consumed here.
+
+        :return: iterator of the items, raises the error of the method
+        """
+        metrics.counter('rpc.client.{0}.calls'.format(func)).inc()
+        chunks = self.backend.call_stream(func, *args, **kwargs)
+        for chunk in chunks:
+            for item in chunk['chunk']:
+                yield item
+            if chunk['end']:
+                if chunk.get('error') is not None:
+                    metrics.counter(
+                        'rpc.client.{0}.errors'.format(func)).inc()
+                    raise chunk['error']
+                return
+            # Items are consumed, the server may send another chunk
+            self.backend.stream_ack(chunk['stream'])
+
+    def call_many(self, calls):
+        """Make several calls in a single round trip.
+
+        `calls` is a list of (func, args, kwargs) tuples, the server runs
+        them concurrently. Results are returned in the same order, a call
+        which failed has its exception in place of the result.
+        """
+        return self.call('_batch', list(calls))
+
+
+class FanOut(object):
+    """Call the same method of many RPC servers.
+
+    Targets are URLs or (ip, port) pairs. At most `parallelism` calls are
+    in progress at the same time and all of them share one deadline,
+    `timeout` seconds after the start of the fan-out.
+    """
+
+    def __init__(self, targets, parallelism=None, timeout=None):
+        self.targets = list(targets)
+        self.parallelism = parallelism or CONF.rpc.fanout_parallelism
+        self.timeout = timeout or CONF.rpc.rcv_timeout
+
+    @staticmethod
+    def _url(target):
+        if isinstance(target, basestring):
+            return target
+        return build_url(*target)
+
+    def call(self, func, *args, **kwargs):
+        """Call every target, yield results as they come.
+
+        Yields (target, result, error) tuples, `error` is the exception
+        raised by the client or returned by the server, in which case
+        `result` is None. Targets which did not reply by the deadline
+        get DAOTimeout.
+        """
+        deadline = time.time() + self.timeout
+        results = queue.LightQueue()
+        pool = eventlet.GreenPool(self.parallelism)
+
+        def run(i, target):
+            try:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise exceptions.DAOTimeout('Deadline exceeded')
+                api = RPCApi(self._url(target), timeout=remaining)
+                result = api.call(func, *args, **kwargs)
+            except (Exception, eventlet.Timeout), exc:
+                results.put((i, target, None, exc))
+            else:
+                if isinstance(result, Exception):
+                    results.put((i, target, None, result))
+                else:
+                    results.put((i, target, result, None))
+
+        def spawn_all():
+            for i, target in enumerate(self.targets):
+                pool.spawn_n(run, i, target)
+
+        spawner = eventlet.spawn(spawn_all)
+        pending = set(range(len(self.targets)))
+        try:
+            while pending:
+                try:
+                    i, target, result, error = results.get(
+                        timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                pending.discard(i)
+                yield target, result, error
+            for i in sorted(pending):
+                yield (self.targets[i], None,
+                       exceptions.DAOTimeout('Deadline exceeded'))
+        finally:
+            spawner.kill()
+
+    def send(self, func, *args, **kwargs):
+        """Send to every target without waiting for replies.
+
+        :return: dict, target to the error of targets not reached
+        """
+        urls = dict((self._url(target), target) for target in self.targets)
+        client_class = rpc_base.Client.get_backend_class()
+        errors = client_class.broadcast(list(urls), func, *args, **kwargs)
+        return dict((urls[url], error) for url, error in errors.items())
+
+
+class RPCFuture(object):
+    """Result of a call made in the background by RPCApi.call_async.
+
+    Mirrors the interface of concurrent.futures.Future. Errors raised by
+    the client, like DAOTimeout, are re-raised by `result`, while errors
+    of the remote method are returned as values, as RPCApi.call does.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._event = event.Event()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+        eventlet.spawn_n(self._run, func, args, kwargs)
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except BaseException, exc:
+            self._exception = exc
+        self._event.send()
+        for callback in self._callbacks:
+            self._invoke(callback)
+
+    def _invoke(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            LOG.warning(traceback.format_exc())
+
+    def _wait(self, timeout):
+        with eventlet.Timeout(timeout, exceptions.DAOTimeout):
+            self._event.wait()
+
+    def done(self):
+        return self._event.ready()
+
+    def result(self, timeout=None):
+        """Wait up to `timeout` seconds for the result of the call"""
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the call, return the error it raised or None"""
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Call `callback(future)` once the call is done"""
+        if self.done():
+            self._invoke(callback)
+        else:
+            self._callbacks.append(callback)
+
+
+class Bulkhead(object):
+    """Concurrency limit of a group of RPC methods.
+
+    At most `size` calls of the group run at the same time and up to
+    `queue` more wait for their turn, calls beyond that are rejected.
+    """
+
+    def __init__(self, size, queue=0):
+        self.size = size
+        self.queue = queue
+        self.semaphore = semaphore.Semaphore(size)
+        self.pending = 0
+
+    def admit(self):
+        """Reserve a place for a call, False if the bulkhead is full"""
+        if self.pending >= self.size + self.queue:
+            return False
+        self.pending += 1
+        return True
+
+    def run(self, func, *args):
+        """Run an admitted call as soon as there is a free slot"""
+        try:
+            with self.semaphore:
+                return func(*args)
+        finally:
+            self.pending -= 1
+
 
 class RPCServer(object):
+    # Methods served besides the public ones defined by subclasses
+    builtins = ('_batch', '_stats', '_profile', '_stream_ack')
+    # Max number of requests taken from the backend at once
+    receive_batch = 100
+
     def __init__(self, port):
-        self.pool = eventlet.GreenPool(10000)
+        self.pool = eventlet.GreenPool(CONF.rpc.pool_size)
         self.backend = rpc_base.Server.get_backend(port)
         self.url = self.backend.url
+        self.handlers = self._get_handlers()
+        self.bulkheads = self._get_bulkheads()
+        self.inflight = 0
+        # Credits of the streams in progress, see _stream
+        self.streams = {}
+        self.profiler = profiler.Profiler()
+        prefix = 'rpc.server.{0}.'.format(self.url)
+        metrics.gauge(prefix + 'pool_free', self.pool.free)
+        metrics.gauge(prefix + 'pool_waiting', self.pool.waiting)
+        metrics.gauge(prefix + 'inflight', lambda: self.inflight)
+        metrics.start_dumps()
+
+    def _get_handlers(self):
+        """Methods callable by clients, looked up once at start up.
+
+        Methods are looked up on the class, properties and other attributes
+        are left alone, they may need the server fully set up to be read.
+        """
+        handlers = {}
+        for name, value in inspect.getmembers(type(self), inspect.isroutine):
+            if name.startswith('_') or hasattr(RPCServer, name):
+                continue
+            handlers[name] = getattr(self, name)
+        for name in self.builtins:
+            handlers[name] = getattr(self, name)
+        return handlers
+
+    def _get_bulkheads(self):
+        bulkheads = {}
+        for group, limits in CONF.rpc.bulkheads.items():
+            bulkhead = Bulkhead(limits['size'], limits.get('queue', 0))
+            for name in limits['methods']:
+                if name not in self.handlers:
+                    LOG.warning('Bulkhead %s: unknown method %s', group, name)
+                bulkheads[name] = bulkhead
+        return bulkheads
 
     def do_main(self):
         while True:
             try:
                 LOG.debug('Waiting RPC request')
-                request = self.backend.get_request()
-                try:
-                    reply_to = request.get('reply_to', None)
-                    func_name = request['function']
-                    args = request['args']
-                    kwargs = request['kwargs']
-                    self._spawn(reply_to, func_name, args, kwargs)
-                except IndexError:
-                    LOG.warning(traceback.format_exc())
+                requests = self.backend.get_requests(self.receive_batch)
+                for request in requests:
+                    try:
+                        reply_to = request.get('reply_to', None)
+                        func_name = request['function']
+                        args = request['args']
+                        kwargs = request['kwargs']
+                        self._spawn(request, reply_to, func_name, args, kwargs)
+                    except (IndexError, KeyError):
+                        LOG.warning(traceback.format_exc())
             except Exception:
                 LOG.warning(traceback.format_exc())
 
-    def _call(self, reply_to, func_name, args, kwargs):
+    def _run(self, func_name, args, kwargs):
         try:
             LOG.debug('Request is: %r', repr(locals()))
-            response = getattr(self, func_name)(*args, **kwargs)
+            try:
+                handler = self.handlers[func_name]
+            except KeyError:
+                raise exceptions.DAONotFound('Unknown RPC method: {0}'.
+                                             format(func_name))
+            metrics.counter(self._metric(func_name, 'calls')).inc()
+            with metrics.histogram(self._metric(func_name, 'latency')).time():
+                response = handler(*args, **kwargs)
             LOG.debug('Response is: %r', repr(response))
         except Exception, exc:
             response = exc
+            metrics.counter(self._metric(func_name, 'errors')).inc()
             LOG.warning(traceback.format_exc())
+        return response
 
-        if reply_to is not None:
+    def _metric(self, func_name, name):
+        """Name of a metric of a method, unknown methods share theirs"""
+        if func_name not in self.handlers:
+            func_name = '_unknown'
+        return 'rpc.server.{0}.{1}'.format(func_name, name)
+
+    def _call(self, request, reply_to, func_name, args, kwargs):
+        try:
+            if func_name in self.handlers:
+                response = self.profiler.run(func_name, self._run,
+                                             func_name, args, kwargs)
+            else:
+                # Names sent by clients are not trusted as profile names
+                response = self._run(func_name, args, kwargs)
+            if reply_to is not None:
+                self._reply(request, reply_to, response)
+        finally:
+            self.inflight -= 1
+            self.backend.done(request)
+
+    def _reply(self, request, reply_to, response):
+        stream_id = request.get('stream')
+        if stream_id:
+            self._stream(reply_to, stream_id, response)
+        else:
             self.backend.send_reply(reply_to, response)
 
-    def _spawn(self, reply_to, func_name, args, kwargs):
+    def _stream(self, reply_to, stream_id, response):
+        """Send the items of `response` in chunks.
+
+        Every chunk but the last takes a credit of the stream, clients
+        give credits back with _stream_ack once they consume a chunk.
+        """
+        if isinstance(response, Exception):
+            items, error = iter(()), response
+        elif isinstance(response, (basestring, dict)) or \
+                not hasattr(response, '__iter__'):
+            items, error = iter([response]), None
+        else:
+            items, error = iter(response), None
+        credits = self.streams[stream_id] = \
+            semaphore.Semaphore(CONF.rpc.stream_window)
+        seq = 0
+        chunk = []
+        try:
+            while True:
+                try:
+                    chunk.append(next(items))
+                except StopIteration:
+                    break
+                except Exception, exc:
+                    LOG.warning(traceback.format_exc())
+                    error = exc
+                    break
+                if len(chunk) < CONF.rpc.stream_chunk_size:
+                    continue
+                if not credits.acquire(timeout=CONF.rpc.send_timeout):
+                    raise exceptions.DAOTimeout('Stream {0} is not consumed'.
+                                                format(stream_id))
+                self.backend.send_reply(reply_to, {'stream': stream_id,
+                                                   'seq': seq,
+                                                   'chunk': chunk,
+                                                   'end': False})
+                seq += 1
+                chunk = []
+            self.backend.send_reply(reply_to, {'stream': stream_id,
+                                               'seq': seq,
+                                               'chunk': chunk,
+                                               'end': True,
+                                               'error': error})
+        finally:
+            del self.streams[stream_id]
+            if hasattr(items, 'close'):
+                items.close()
+
+    def _stream_ack(self, stream_id, n=1):
+        """Give `n` credits back to a stream"""
+        credits = self.streams.get(stream_id)
+        if credits is not None:
+            for _ in range(n):
+                credits.release()
+
+    def _batch(self, calls):
+        """Serve RPCApi.call_many, calls run in the pool of the server"""
+        pile = eventlet.GreenPile(self.pool)
+        for func_name, args, kwargs in calls:
+            bulkhead = self.bulkheads.get(func_name)
+            if bulkhead is None:
+                pile.spawn(self._run, func_name, args, kwargs)
+            elif bulkhead.admit():
+                pile.spawn(bulkhead.run, self._run, func_name, args, kwargs)
+            else:
+                pile.spawn(self._busy, func_name)
+        return list(pile)
+
+    def _stats(self):
+        """Snapshot of the metrics of the server process"""
+        return metrics.snapshot()
+
+    def _profile(self, func_name=None, seconds=None, sample_rate=None):
+        """Change what is profiled at runtime.
+
+        Profiles every request of `func_name` for `seconds`, 0 stops it,
+        and/or sets the share of requests sampled.
+        :return: profiling status
+        """
+        if func_name is not None:
+            if func_name not in self.handlers:
+                raise exceptions.DAONotFound('Unknown RPC method: {0}'.
+                                             format(func_name))
+            self.profiler.enable(func_name, seconds)
+        if sample_rate is not None:
+            self.profiler.sample_rate = sample_rate
+        return self.profiler.status()
+
+    @staticmethod
+    def _busy(func_name):
+        return exceptions.DAOServerBusy('Too many {0} requests'.
+                                        format(func_name))
+
+    def _spawn(self, request, reply_to, func_name, args, kwargs):
         LOG.debug('Spawning thread for %s, pool: %s',
                   func_name, self.pool.free())
-        self.pool.spawn_n(self._call, reply_to, func_name, args, kwargs)
+        if func_name == '_stream_ack':
+            # Streams wait for credits however busy the server is
+            try:
+                self._run(func_name, args, kwargs)
+            finally:
+                self.backend.done(request)
+            return
+        if CONF.rpc.max_inflight and self.inflight >= CONF.rpc.max_inflight:
+            LOG.warning('Reject %s request, server is busy', func_name)
+            self._reject(request, reply_to, func_name)
+            return
+        bulkhead = self.bulkheads.get(func_name)
+        if bulkhead is None:
+            self.inflight += 1
+            self.pool.spawn_n(self._call, request,
+                              reply_to, func_name, args, kwargs)
+        elif bulkhead.admit():
+            self.inflight += 1
+            self.pool.spawn_n(bulkhead.run, self._call, request,
+                              reply_to, func_name, args, kwargs)
+        else:
+            LOG.warning('Reject %s request, bulkhead is full', func_name)
+            self._reject(request, reply_to, func_name)
+
+    def _reject(self, request, reply_to, func_name):
+        metrics.counter(self._metric(func_name, 'rejected')).inc()
+        try:
+            if reply_to is not None:
+                self._reply(request, reply_to, self._busy(func_name))
+        finally:
+            self.backend.done(request)
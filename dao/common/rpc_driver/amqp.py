@@ -14,15 +14,20 @@
 # under the License.
 
 import amqpy
+import collections
+import contextlib
 import eventlet
-import yaml
 import uuid
 import time
+from eventlet import event
+from eventlet import queue
+from eventlet import semaphore
 
 from dao.common import config
 from dao.common import exceptions
 from dao.common import log
 from dao.common.rpc_driver import base
+from dao.common.rpc_driver import codec
 
 
 opts = [
@@ -38,12 +43,46 @@ opts = [
                   help='Keep alive heardbeat'),
     config.IntOpt('rabbit', 'reconnect_on', default=2,
                   help='Reconnect timeout'),
+    config.IntOpt('rabbit', 'pool_size', default=10,
+                  help='Max number of connections RPC clients share to talk '
+                       'to the broker'),
+    config.IntOpt('rabbit', 'pool_idle_timeout', default=30,
+                  help='Close pooled channels idle for longer, seconds'),
+    config.BoolOpt('rabbit', 'shared_reply_queue', default=False,
+                   help='Publish to server queues directly and receive '
+                        'replies on a single queue per process'),
 ]
 config.register(opts)
 CONF = config.get_config()
 logger = log.getLogger(__name__)
 
 
+# Codec of the peers which do not set message content type
+LEGACY_CODEC = 'yaml'
+
+
+def encode(data, data_codec, accept=None, **properties):
+    """Message of `data`, `accept` as in codec.compress"""
+    body, compression = codec.compress(data_codec.dumps(data), accept)
+    headers = {'accept_compression': codec.ACCEPT_COMPRESSION}
+    if compression is not None:
+        headers['compression'] = compression
+    if data_codec.binary or compression is not None:
+        # amqpy leaves bodies in an unknown encoding as they are
+        properties['content_encoding'] = 'binary'
+    return amqpy.Message(body,
+                         content_type=data_codec.content_type,
+                         application_headers=headers,
+                         **properties)
+
+
+def decode(msg):
+    content_type = msg.properties.get('content_type')
+    headers = msg.properties.get('application_headers') or {}
+    body = codec.decompress(msg.body, headers.get('compression'))
+    return codec.for_content_type(content_type, LEGACY_CODEC).loads(body)
+
+
 def get_connection():
     return amqpy.Connection(
         host=CONF.rabbit.host,
@@ -54,49 +93,357 @@ def get_connection():
     )
 
 
+class Connection(object):
+    """Broker connection of the pool, shared by many channels.
+
+    amqpy reads the socket in the thread waiting for a method, so one green
+    thread at a time may read it: synchronous methods and the drain of
+    deliveries take `lock`. They run in green threads of their own, a caller
+    timing out never leaves a frame half read.
+    """
+
+    # Seconds the reader holds the socket for, synchronous methods wait it out
+    poll = 0.01
+
+    def __init__(self):
+        self.connection = get_connection()
+        self.lock = semaphore.Semaphore()
+        # Number of open channels
+        self.channels = 0
+        # Calls waiting for deliveries, their queues by amqpy channel
+        self.waiters = {}
+        self.reader = None
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.run(self.connection.close)
+        except Exception, exc:
+            logger.info('While closing connection: {0}'.format(repr(exc)))
+
+    def is_alive(self):
+        return self.connection.connected
+
+    def run(self, func, *args, **kwargs):
+        """Call `func` which may read from the socket"""
+        return eventlet.spawn(self._locked, func, *args, **kwargs).wait()
+
+    def _locked(self, func, *args, **kwargs):
+        with self.lock:
+            return func(*args, **kwargs)
+
+    def wait(self, replies, channel):
+        """Next message put in `replies` by a consumer on `channel`"""
+        self.waiters[replies] = channel
+        try:
+            if self.reader is None:
+                self.reader = eventlet.spawn(self._read)
+            msg = replies.get()
+        finally:
+            del self.waiters[replies]
+        if isinstance(msg, Exception):
+            raise msg
+        return msg
+
+    def _read(self):
+        try:
+            while self.waiters:
+                with self.lock:
+                    try:
+                        self.connection.drain_events(timeout=self.poll)
+                    except amqpy.Timeout:
+                        pass
+                    except amqpy.ChannelError, exc:
+                        # amqpy has closed the channel the error is about
+                        self._fail(exc, closed_only=True)
+        except Exception, exc:
+            logger.warning('While draining pooled connection: {0}'.format(
+                repr(exc)))
+            self._fail(exc)
+        finally:
+            self.reader = None
+
+    def _fail(self, exc, closed_only=False):
+        for replies, channel in self.waiters.items():
+            if not closed_only or not channel.is_open:
+                replies.put(exc)
+
+
 class Channel(object):
+    """Channel borrowed from the pool, see ChannelPool"""
+
     def __init__(self):
         self.channel = None
         self.connection = None
+        self.last_used = None
+        # Whether a message went out since the channel was borrowed
+        self.published = False
+
+    def open(self, connection):
+        # Counted from now on, the pool spreads concurrent opens
+        connection.channels += 1
+        try:
+            self.channel = connection.run(connection.connection.channel)
+        except BaseException:
+            connection.channels -= 1
+            raise
+        self.connection = connection
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.connection.run(self.channel.close)
+        except Exception, exc:
+            logger.info('While closing channel: {0}'.format(repr(exc)))
+        self.connection.channels -= 1
+
+    def is_alive(self):
+        return self.connection.is_alive() and self.channel.is_open
+
+    def call(self, method, *args, **kwargs):
+        """Call a synchronous `method` of the amqpy channel"""
+        return self.connection.run(getattr(self.channel, method),
+                                   *args, **kwargs)
+
+    def publish(self, msg, **kwargs):
+        self.channel.basic_publish(msg, **kwargs)
+        self.published = True
+
+    def wait(self, replies):
+        """Next message put in `replies` by a consumer of the channel"""
+        return self.connection.wait(replies, self.channel)
+
+
+class ChannelPool(object):
+    """Channels of RPC clients over at most `size` broker connections.
+
+    Connections are shared, each one carries the channels of many callers,
+    so calls waiting for replies hold a channel and no connection of their
+    own. New channels go to a new connection while there are less than
+    `size`, to the one with the fewest channels then. Idle channels are
+    reused most recently used first, those unused for longer than
+    `idle_timeout` seconds are closed, and so are connections left with no
+    channel. A channel is dropped if the borrower fails with it, since its
+    state is unknown then, and its connection too if it is dead.
+    """
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connections = []
+        self.free = collections.deque()
+        # Held while picking a connection, size is a hard limit
+        self.lock = semaphore.Semaphore()
+
+    @contextlib.contextmanager
+    def channel(self):
+        channel = self._acquire()
+        try:
+            yield channel
+        except BaseException:
+            self._drop(channel)
+            raise
+        channel.last_used = channel.connection.last_used = time.time()
+        self.free.append(channel)
+
+    def run(self, func, *args, **kwargs):
+        """Call `func(channel, ...)` on a pooled channel, see `retry`"""
+        with self.channel() as channel:
+            return self.retry(channel, func, channel, *args, **kwargs)
+
+    def retry(self, channel, func, *args, **kwargs):
+        """Call `func`, once more on a fresh `channel` if the first call
+        fails on a dead connection before anything was published.
+
+        Pooled connections turn out to be dead only once they are used.
+        """
+        try:
+            return func(*args, **kwargs)
+        except exceptions.DAOException:
+            raise
+        except Exception, exc:
+            if channel.published or channel.connection.is_alive():
+                raise
+            logger.info('Retry on a fresh channel: {0}'.format(repr(exc)))
+        self._drop(channel)
+        channel.open(self._connection())
+        return func(*args, **kwargs)
+
+    def _acquire(self):
+        self._evict_idle()
+        while self.free:
+            channel = self.free.pop()
+            if channel.is_alive():
+                break
+            logger.info('Drop broken pooled channel')
+            self._drop(channel)
+        else:
+            channel = Channel()
+            channel.open(self._connection())
+        channel.published = False
+        return channel
+
+    def _connection(self):
+        with self.lock:
+            for connection in list(self.connections):
+                if not connection.is_alive():
+                    logger.info('Drop broken pooled connection')
+                    self._close(connection)
+            if len(self.connections) < self.size:
+                self.connections.append(Connection())
+                return self.connections[-1]
+            return min(self.connections, key=lambda c: c.channels)
+
+    def _drop(self, channel):
+        channel.close()
+        connection = channel.connection
+        if not connection.is_alive() and connection in self.connections:
+            logger.info('Drop broken pooled connection')
+            self._close(connection)
+
+    def _close(self, connection):
+        self.connections.remove(connection)
+        # Channels go away with their connection
+        self.free = collections.deque(c for c in self.free
+                                      if c.connection is not connection)
+        connection.close()
+
+    def _evict_idle(self):
+        expired = time.time() - self.idle_timeout
+        while self.free and self.free[0].last_used < expired:
+            self.free.popleft().close()
+        for connection in list(self.connections):
+            if not connection.channels and connection.last_used < expired:
+                self.connections.remove(connection)
+                connection.close()
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ChannelPool(CONF.rabbit.pool_size,
+                            CONF.rabbit.pool_idle_timeout)
+    return _pool
+
+
+class ReplyQueue(object):
+    """Long-lived reply queue shared by all RPC calls of the process.
+
+    Requests carry `reply_to` and `correlation_id` message properties, and
+    a single consumer green thread hands replies over to the waiting calls.
+    """
 
-    def __enter__(self):
+    def __init__(self):
+        self.name = 'client_' + uuid.uuid4().hex
+        self.waiters = {}
+        # Connection of its own, the consumer is its only reader
+        self.connection = None
+        self.setup()
+        eventlet.spawn_n(self._consume)
+
+    def setup(self):
         self.connection = get_connection()
-        self.channel = self.connection.channel()
-        return self
+        ch = self.connection.channel()
+        ch.queue_declare(self.name, exclusive=True)
+        ch.basic_consume(self.name, callback=self.on_message, no_ack=True)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.channel.close()
-        self.connection.close()
+    def wait_for(self, correlation_id):
+        waiter = self.waiters[correlation_id] = event.Event()
+        return waiter
 
+    def stream_for(self, correlation_id):
+        """Queue of the replies to a streamed call"""
+        waiter = self.waiters[correlation_id] = queue.LightQueue()
+        return waiter
 
-class Exchange(object):
-    def __init__(self, name, _type, channel):
-        self.name = name
-        self.type = _type
-        self.channel = channel
+    def forget(self, correlation_id):
+        self.waiters.pop(correlation_id, None)
 
-    def __enter__(self):
-        self.channel.exchange_declare(self.name, self.type)
-        return self
+    def on_message(self, msg):
+        correlation_id = msg.properties.get('correlation_id')
+        waiter = self.waiters.get(correlation_id)
+        if waiter is None:
+            logger.info('Drop reply for unknown call {0}'.format(
+                correlation_id))
+        elif isinstance(waiter, queue.LightQueue):
+            # Streams get many replies, the caller forgets them at the end
+            waiter.put(msg)
+        else:
+            del self.waiters[correlation_id]
+            waiter.send(msg)
+
+    def _consume(self):
+        while True:
+            try:
+                self.connection.drain_events(timeout=None)
+            except Exception, exc:
+                logger.warning('While draining replies: {0}'.format(
+                    repr(exc)))
+                try:
+                    self.connection.close()
+                except Exception, exc:
+                    logger.info('While closing connection: {0}'.format(
+                        repr(exc)))
+                # Replies to the calls in progress are lost with the queue
+                waiters, self.waiters = self.waiters, {}
+                for waiter in waiters.values():
+                    exc = exceptions.DAOException('Reply queue connection '
+                                                  'lost')
+                    if isinstance(waiter, queue.LightQueue):
+                        waiter.put(exc)
+                    else:
+                        waiter.send_exception(exc)
+                self._reconnect()
+
+    def _reconnect(self):
+        while True:
+            time.sleep(CONF.rabbit.reconnect_on)
+            try:
+                self.setup()
+                return
+            except Exception, exc:
+                logger.info('While setuping connection: {0}'.format(
+                    repr(exc)))
+
+
+_reply_queue = None
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.channel.exchange_delete(self.name)
 
+def get_reply_queue():
+    global _reply_queue
+    if _reply_queue is None:
+        _reply_queue = ReplyQueue()
+    return _reply_queue
 
-class Queue(object):
-    def __init__(self, name, channel, exclusive=True):
+
+def stream_ack_queue(url):
+    """Queue of the stream acks sent to the server at `url`.
+
+    The server consumes it apart from requests and without prefetch limit,
+    so that streams waiting for their credits never hold acks up.
+    """
+    return url + '_stream_ack'
+
+
+# Server queues known to exist, checked once per process
+_known_queues = set()
+
+
+class Exchange(object):
+    def __init__(self, name, _type, channel):
         self.name = name
+        self.type = _type
         self.channel = channel
-        self.exclusive = exclusive
-        self.queue = None
 
     def __enter__(self):
-        self.queue = self.channel.queue_declare(self.name,
-                                                exclusive=self.exclusive)
+        self.channel.call('exchange_declare', self.name, self.type)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.channel.queue_delete(self.name)
+        self.channel.call('exchange_delete', self.name)
 
 
 class Client(base.Client):
@@ -104,7 +451,9 @@ class Client(base.Client):
         # In order to keep compatibility with the code that uses ZMQ
         # there is an assumption that queues are named like ZMQ urls.
         super(Client, self).__init__(connect_url, ip, port, timeout)
-        self.message = None
+        self.codec = codec.get_codec(LEGACY_CODEC)
+        # Channels of the streams in progress by stream id
+        self.streams = {}
 
     def _get_exchange_name(self):
         return '_'.join((str(uuid.uuid4()), self.connect_url))
@@ -113,10 +462,52 @@ class Client(base.Client):
         data = {'function': func,
                 'args': args,
                 'kwargs': kwargs}
-        with Channel() as channel:
-            self._send(channel, data)
+        if CONF.rabbit.shared_reply_queue:
+            get_pool().run(self._publish, data)
+        else:
+            get_pool().run(self._send, data)
+
+    @classmethod
+    def broadcast(cls, urls, func, *args, **kwargs):
+        """Publish a single message to a temporary fanout exchange"""
+        errors = {}
+        queues = []
+        for url in set(urls):
+            if url not in _known_queues:
+                try:
+                    # Broker closes the channel on a missing queue,
+                    # check every queue on a channel of its own
+                    get_pool().run(Channel.call, 'queue_declare', url,
+                                   passive=True)
+                except amqpy.NotFound:
+                    errors[url] = exceptions.DAONotFound(
+                        'Unable to connect to {0}'.format(url))
+                    continue
+                except Exception, exc:
+                    errors[url] = exc
+                    continue
+                _known_queues.add(url)
+            queues.append(url)
+        if not queues:
+            return errors
+        data = {'function': func,
+                'args': args,
+                'kwargs': kwargs}
+        msg = encode(data, codec.get_codec(LEGACY_CODEC))
+        get_pool().run(cls._fanout, queues, msg)
+        return errors
+
+    @staticmethod
+    def _fanout(channel, queues, msg):
+        name = 'fanout_' + uuid.uuid4().hex
+        with Exchange(name, 'fanout', channel) as exchange:
+            for url in queues:
+                channel.call('queue_bind', url, exchange=exchange.name)
+            channel.publish(msg, exchange=exchange.name)
 
     def call(self,  func, *args, **kwargs):
+        if CONF.rabbit.shared_reply_queue:
+            return self._call_shared(func, args, kwargs)
         # Queue name for reply_to
         rq_name = 'client_' + uuid.uuid4().hex
         data = {'reply_to': rq_name,
@@ -124,34 +515,144 @@ class Client(base.Client):
                 'args': args,
                 'kwargs': kwargs}
         with eventlet.Timeout(self.timeout):
-            with Channel() as channel:
+            with get_pool().channel() as channel:
                 return self._call(channel, data)
 
     def _send(self, channel, data):
-        ch = channel.channel
-        with Exchange(self._get_exchange_name(), 'direct', ch) as exchange:
+        with Exchange(self._get_exchange_name(), 'direct',
+                      channel) as exchange:
             try:
-                ch.queue_bind(self.connect_url, exchange=exchange.name)
+                channel.call('queue_bind', self.connect_url,
+                             exchange=exchange.name)
             except amqpy.NotFound:
                 raise exceptions.DAONotFound('Unable to connect to {0}'.
                                              format(self.connect_url))
-            ch.basic_publish(amqpy.Message(yaml.dump(data)),
-                             exchange=exchange.name,
-                             mandatory=True)
+            channel.publish(encode(data, self.codec),
+                            exchange=exchange.name,
+                            mandatory=True)
 
     def _call(self, channel, data):
-        ch = channel.channel
-        self.message = None
-        with Queue(data['reply_to'], ch) as reply_to:
-            ch.basic_consume(data['reply_to'], callback=self.on_message)
-            self._send(channel, data)
+        replies = self._replies(channel, data)
+        try:
+            return next(replies)
+        finally:
+            replies.close()
+
+    def _replies(self, channel, data):
+        """Send a request, yield replies from its own reply queue.
+
+        The consumer of the queue lives on the pooled `channel`, other calls
+        share its connection while waiting, see Connection.
+        """
+        # Replies are kept by the call, so a client may make concurrent calls
+        replies = queue.LightQueue()
+        tag = get_pool().retry(channel, self._subscribe, channel, data,
+                               replies)
+        try:
             while True:
-                channel.connection.drain_events(timeout=None)
-                if self.message:
-                    return yaml.load(self.message.body)
+                yield decode(channel.wait(replies))
+        finally:
+            # Channel goes back to the pool, keep it free of consumers
+            channel.call('basic_cancel', tag)
+            channel.call('queue_delete', data['reply_to'])
+
+    def _subscribe(self, channel, data, replies):
+        """Consume the reply queue of a request, then send the request"""
+        channel.call('queue_declare', data['reply_to'], exclusive=True)
+        tag = channel.call('basic_consume', data['reply_to'],
+                           callback=replies.put)
+        self._send(channel, data)
+        return tag
+
+    def call_stream(self, func, *args, **kwargs):
+        data = {'function': func,
+                'args': args,
+                'kwargs': kwargs,
+                'stream': uuid.uuid4().hex}
+        if CONF.rabbit.shared_reply_queue:
+            return base.ordered_chunks(self._stream_shared(data))
+        data['reply_to'] = 'client_' + uuid.uuid4().hex
+        return base.ordered_chunks(self._stream(data))
+
+    def _stream(self, data):
+        with get_pool().channel() as channel:
+            replies = self._replies(channel, data)
+            self.streams[data['stream']] = channel
+            try:
+                while True:
+                    with eventlet.Timeout(self.timeout):
+                        chunk = next(replies)
+                    try:
+                        yield chunk
+                    except GeneratorExit:
+                        # Stream is over, the channel is fine to reuse
+                        return
+            finally:
+                del self.streams[data['stream']]
+                replies.close()
+
+    def stream_ack(self, stream_id):
+        data = {'function': '_stream_ack',
+                'args': (stream_id,),
+                'kwargs': {}}
+        msg = encode(data, self.codec)
+        routing_key = stream_ack_queue(self.connect_url)
+        channel = self.streams.get(stream_id)
+        if channel is not None:
+            # The stream waits for the chunk on its channel, publishing
+            # does not read from it
+            channel.publish(msg, routing_key=routing_key)
+            return
+        with eventlet.Timeout(self.timeout):
+            get_pool().run(Channel.publish, msg, routing_key=routing_key)
 
-    def on_message(self, msg):
-            self.message = msg
+    def _publish(self, channel, data, **properties):
+        """Publish to the server queue through the default exchange"""
+        if self.connect_url not in _known_queues:
+            try:
+                channel.call('queue_declare', self.connect_url, passive=True)
+            except amqpy.NotFound:
+                raise exceptions.DAONotFound('Unable to connect to {0}'.
+                                             format(self.connect_url))
+            _known_queues.add(self.connect_url)
+        channel.publish(encode(data, self.codec, **properties),
+                        routing_key=self.connect_url,
+                        mandatory=True)
+
+    def _call_shared(self, func, args, kwargs):
+        data = {'function': func,
+                'args': args,
+                'kwargs': kwargs}
+        reply_queue = get_reply_queue()
+        correlation_id = uuid.uuid4().hex
+        waiter = reply_queue.wait_for(correlation_id)
+        try:
+            with eventlet.Timeout(self.timeout):
+                get_pool().run(self._publish, data,
+                               reply_to=reply_queue.name,
+                               correlation_id=correlation_id)
+                msg = waiter.wait()
+        finally:
+            reply_queue.forget(correlation_id)
+        return decode(msg)
+
+    def _stream_shared(self, data):
+        reply_queue = get_reply_queue()
+        correlation_id = uuid.uuid4().hex
+        waiter = reply_queue.stream_for(correlation_id)
+        try:
+            with eventlet.Timeout(self.timeout):
+                get_pool().run(self._publish, data,
+                               reply_to=reply_queue.name,
+                               correlation_id=correlation_id)
+            while True:
+                with eventlet.Timeout(self.timeout):
+                    msg = waiter.get()
+                if isinstance(msg, Exception):
+                    raise msg
+                yield decode(msg)
+        finally:
+            reply_queue.forget(correlation_id)
 
 
 class Server(base.Server):
@@ -159,38 +660,77 @@ class Server(base.Server):
         super(Server, self).__init__(port)
         self.conn = None
         self.ch = None
+        self.ack_ch = None
         self.consumer = None
-        self.message = None
+        # Messages received by the consumer, not handed out yet
+        self.messages = collections.deque()
         self.setup_connection()
         self.setup_queue()
 
     def get_request(self):
-        self.message = None
         while True:
+            requests = self.get_requests(1)
+            if requests:
+                return requests[0]
+
+    def get_requests(self, max_n):
+        while not self.messages:
+            self._drain()
+        requests = []
+        while self.messages and len(requests) < max_n:
+            msg = self.messages.popleft()
             try:
-                self.conn.drain_events(timeout=None)
-                if self.message is not None:
-                    return yaml.load(self.message.body)
+                requests.append(self._to_request(msg))
             except Exception, exc:
-                # Hot fix, reconnect on amqp errors
-                logger.warning('While draining events: {0}'.format(repr(exc)))
-                # Try to delete old staff
-                try:
-                    self.ch.queue_delete(self.url)
-                    self.conn.close()
-                except Exception, exc:
-                    logger.info('While closing old connection: {0}'.
-                                format(repr(exc)))
-                # Recreate new one
-                try:
-                    if not self.conn.connected:
-                        self.setup_connection()
-                        self.setup_queue()
-                except Exception, exc:
-                    logger.info('While setuping connection: {0}'.format(
-                        repr(exc)))
-                    time.sleep(CONF.rabbit.reconnect_on)
-                    raise
+                logger.warning('Drop malformed request: {0}'.format(
+                    repr(exc)))
+                if CONF.rpc.max_inflight:
+                    self.done({'delivery': (msg.channel, msg.delivery_tag)})
+        return requests
+
+    def _drain(self):
+        try:
+            self.conn.drain_events(timeout=None)
+        except Exception, exc:
+            # Hot fix, reconnect on amqp errors
+            logger.warning('While draining events: {0}'.format(repr(exc)))
+            # Try to delete old staff
+            try:
+                self.ch.queue_delete(self.url)
+                self.conn.close()
+            except Exception, exc:
+                logger.info('While closing old connection: {0}'.
+                            format(repr(exc)))
+            if CONF.rpc.max_inflight:
+                # Unacked messages are redelivered to the new channel
+                self.messages.clear()
+            # Recreate new one
+            try:
+                if not self.conn.connected:
+                    self.setup_connection()
+                    self.setup_queue()
+            except Exception, exc:
+                logger.info('While setuping connection: {0}'.format(
+                    repr(exc)))
+                time.sleep(CONF.rabbit.reconnect_on)
+                raise
+
+    def _to_request(self, msg):
+        request = decode(msg)
+        correlation_id = msg.properties.get('correlation_id')
+        if correlation_id is not None:
+            # Caller waits on a shared reply queue, see ReplyQueue
+            request['reply_to'] = msg.properties['reply_to']
+        if request.get('reply_to') is not None:
+            # Reply is encoded with the codec of the request, and
+            # compressed only if its sender decompresses it
+            headers = msg.properties.get('application_headers') or {}
+            request['reply_to'] = (request['reply_to'], correlation_id,
+                                   msg.properties.get('content_type'),
+                                   headers.get('accept_compression', ''))
+        if CONF.rpc.max_inflight and msg.channel is self.ch:
+            request['delivery'] = (msg.channel, msg.delivery_tag)
+        return request
 
     def setup_connection(self):
         self.conn = get_connection()
@@ -198,14 +738,40 @@ class Server(base.Server):
 
     def setup_queue(self):
         self.ch.queue_declare(self.url)
+        # With in-flight limit the broker holds requests beyond it
+        no_ack = not CONF.rpc.max_inflight
+        if not no_ack:
+            self.ch.basic_qos(prefetch_count=CONF.rpc.max_inflight)
         self.consumer = self.ch.basic_consume(self.url,
                                               callback=self.on_event,
-                                              no_ack=True)
+                                              no_ack=no_ack)
+        # Channel of its own, prefetch applies to every consumer of one
+        self.ack_ch = self.conn.channel()
+        ack_queue = stream_ack_queue(self.url)
+        self.ack_ch.queue_declare(ack_queue, exclusive=True)
+        self.ack_ch.basic_consume(ack_queue, callback=self.on_event,
+                                  no_ack=True)
 
     def on_event(self, msg):
-        print 'message received'
-        self.message = msg
+        self.messages.append(msg)
+
+    def done(self, request):
+        delivery = request.get('delivery')
+        if delivery is None:
+            return
+        channel, delivery_tag = delivery
+        # Unacked messages of a lost channel are redelivered by the broker
+        if channel is self.ch:
+            try:
+                channel.basic_ack(delivery_tag)
+            except Exception, exc:
+                logger.warning('While acking request: {0}'.format(repr(exc)))
 
     def send_reply(self, reply_to, data):
-        self.ch.basic_publish(amqpy.Message(yaml.dump(data)),
+        reply_to, correlation_id, content_type, accept = reply_to
+        properties = {}
+        if correlation_id is not None:
+            properties['correlation_id'] = correlation_id
+        reply_codec = codec.for_content_type(content_type, LEGACY_CODEC)
+        self.ch.basic_publish(encode(data, reply_codec, accept, **properties),
                               routing_key=reply_to)
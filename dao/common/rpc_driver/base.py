@@ -29,6 +29,14 @@ opts = [
                   help='Send message timeout'),
     config.StrOpt('rpc', 'driver', default='dao.common.rpc_driver.amqp',
                   help='PRC driver implementation'),
+    config.IntOpt('rpc', 'max_inflight', default=0,
+                  help='Max number of requests a server has in progress, '
+                       'also used as AMQP prefetch. 0 means no limit'),
+    config.IntOpt('rpc', 'zmq_frame_min_bytes', default=0,
+                  help='ZMQ drivers send binary arguments and results '
+                       '(bytearray, buffer, memoryview) of at least this '
+                       'size as frames of their own, received as '
+                       'memoryviews. 0 disables it'),
 ]
 config.register(opts)
 CONF = config.get_config()
@@ -36,6 +44,24 @@ CONF = config.get_config()
 LOG = log.getLogger(__name__)
 
 
+def ordered_chunks(chunks):
+    """Yield chunks of a streamed reply in order, up to the last one.
+
+    Drivers which may deliver the chunks of a stream out of order pass
+    them through it, chunks are numbered by their `seq` key.
+    """
+    pending = {}
+    seq = 0
+    for chunk in chunks:
+        pending[chunk['seq']] = chunk
+        while seq in pending:
+            chunk = pending.pop(seq)
+            seq += 1
+            yield chunk
+            if chunk['end']:
+                return
+
+
 def build_url(ip, port):
     url = CONF.rpc.url_pattern.format(ip=ip, port=port)
     if port is None:
@@ -44,15 +70,26 @@ def build_url(ip, port):
 
 
 class Loadable(object):
+    # Driver modules are imported once per process, so that module-level
+    # state (connection pools, sockets, consumers) is shared by all backends.
+    _modules = {}
+
+    @classmethod
+    def get_backend_class(cls):
+        """Class of the configured driver implementing `cls`"""
+        name = CONF.rpc.driver
+        module = cls._modules.get(name)
+        if module is None:
+            LOG.debug('Load client from %s', name)
+            module = cls._modules[name] = eventlet.import_patched(name)
+        return getattr(module, cls.__name__)
+
     @classmethod
     def get_backend(cls, *args, **kwargs):
         """
         :rtype: cls.__name__
         """
-        module = CONF.rpc.driver
-        LOG.debug('Load client from %s', module)
-        module = eventlet.import_patched(module)
-        return getattr(module, cls.__name__)(*args, **kwargs)
+        return cls.get_backend_class()(*args, **kwargs)
 
 
 class Client(Loadable):
@@ -81,6 +118,36 @@ class Client(Loadable):
     def send(self, func, *args, **kwargs):
         pass
 
+    @abc.abstractmethod
+    def call_stream(self, func, *args, **kwargs):
+        """Call a method with the reply streamed in chunks.
+
+        :return: iterator of chunks in order, dicts with keys stream, seq,
+                 chunk (list of items), end and, in the last one, error
+        """
+        pass
+
+    def stream_ack(self, stream_id):
+        """Tell the server a chunk of a stream is consumed, see call_stream"""
+        self.send('_stream_ack', stream_id)
+
+    @classmethod
+    def broadcast(cls, urls, func, *args, **kwargs):
+        """Send the same request to every server in `urls`.
+
+        Drivers override it when the transport can deliver a single
+        message to many servers.
+
+        :return: dict, url to the error of servers not reached
+        """
+        errors = {}
+        for url in urls:
+            try:
+                cls(url).send(func, *args, **kwargs)
+            except Exception, exc:
+                errors[url] = exc
+        return errors
+
 
 class Server(Loadable):
     def __init__(self, port):
@@ -93,6 +160,17 @@ class Server(Loadable):
         """
         pass
 
+    def get_requests(self, max_n):
+        """Wait for requests, returns up to `max_n` of them already received
+
+        :return: list of dicts as returned by `get_request`
+        """
+        return [self.get_request()]
+
     @abc.abstractmethod
     def send_reply(self, reply_to, data):
         pass
+
+    def done(self, request):
+        """Called once `request` is served, e.g. to acknowledge it"""
+        pass
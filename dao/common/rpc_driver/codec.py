@@ -0,0 +1,305 @@
+#
+# Copyright 2016 Symantec.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Serialization of RPC payloads.
+
+Every message carries the content type of its codec, so a peer decodes it
+with the right codec whatever its own setting is. Servers reply with the
+codec of the request, which lets clients switch codecs one by one.
+Messages are decoded only with the codecs of `[rpc] accepted_codecs`, by
+default the one in use and the one of legacy peers, since some codecs
+(pickle, full YAML loader) run code on behalf of the sender.
+
+Bodies of at least `[rpc] compress_min_bytes` are compressed, which the
+message envelope tells the receiver. Clients advertise the algorithms
+they decompress and servers compress replies only for clients which did,
+so older clients keep working. Servers must be upgraded before clients
+enable compression of requests.
+"""
+
+import bz2
+import cPickle as pickle
+import json
+import sys
+import yaml
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from dao.common import config
+from dao.common import exceptions
+
+opts = [
+    config.StrOpt('rpc', 'codec', default='',
+                  help='RPC payload codec: json, msgpack, pickle or yaml. '
+                       'Driver specific if empty'),
+    config.StrOpt('rpc', 'accepted_codecs', default='',
+                  help='Codecs of the RPC payloads to decode, comma '
+                       'separated. If empty, the codec in use and the '
+                       'one of legacy peers of the driver'),
+    config.IntOpt('rpc', 'compress_min_bytes', default=0,
+                  help='Compress RPC payloads of at least this size, '
+                       '0 disables compression'),
+    config.StrOpt('rpc', 'compress_algorithm', default='zlib',
+                  help='RPC payload compression: zlib or bz2'),
+]
+config.register(opts)
+CONF = config.get_config()
+
+
+def _encode_object(obj):
+    """Represent objects which have no JSON/msgpack counterpart"""
+    if isinstance(obj, BaseException):
+        cls = type(obj)
+        return {'__exception__': '.'.join((cls.__module__, cls.__name__)),
+                'args': obj.args,
+                'attrs': obj.__dict__}
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('{0!r} is not serializable'.format(obj))
+
+
+def _decode_object(obj):
+    if '__exception__' not in obj:
+        return obj
+    module, name = obj['__exception__'].rsplit('.', 1)
+    # Never import modules on behalf of a peer
+    cls = getattr(sys.modules.get(module), name, None)
+    if not (isinstance(cls, type) and issubclass(cls, BaseException)):
+        cls = exceptions.DAOException
+    exc = cls.__new__(cls)
+    exc.args = tuple(obj['args'])
+    exc.__dict__.update(obj['attrs'])
+    return exc
+
+
+class Codec(object):
+    name = None
+    content_type = None
+    # Binary payloads must not be treated as text by the transport
+    binary = False
+
+    def dumps(self, data):
+        raise NotImplementedError()
+
+    def loads(self, body):
+        raise NotImplementedError()
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+
+    def dumps(self, data):
+        return json.dumps(data, default=_encode_object)
+
+    def loads(self, body):
+        return json.loads(body, object_hook=_decode_object)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    binary = True
+
+    def dumps(self, data):
+        return msgpack.packb(data, default=_encode_object, use_bin_type=True)
+
+    def loads(self, body):
+        return msgpack.unpackb(body, object_hook=_decode_object, raw=False)
+
+
+class PickleCodec(Codec):
+    name = 'pickle'
+    content_type = 'application/x-python-pickle'
+    binary = True
+
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, body):
+        return pickle.loads(body)
+
+
+class YAMLCodec(Codec):
+    name = 'yaml'
+    content_type = 'application/x-yaml'
+
+    def dumps(self, data):
+        return yaml.dump(data)
+
+    def loads(self, body):
+        # Full loader, legacy peers send exceptions as python objects
+        return yaml.load(body, Loader=yaml.Loader)
+
+
+_codecs = [JSONCodec(), PickleCodec(), YAMLCodec()]
+if msgpack is not None:
+    _codecs.append(MsgpackCodec())
+CODECS = dict((codec.name, codec) for codec in _codecs)
+CONTENT_TYPES = dict((codec.content_type, codec) for codec in _codecs)
+
+
+COMPRESSIONS = {'zlib': zlib, 'bz2': bz2}
+# Sent by clients to tell servers which replies they decompress
+ACCEPT_COMPRESSION = ','.join(sorted(COMPRESSIONS))
+
+
+def compress(body, accept=None):
+    """Compress `body` if it is large enough.
+
+    :param accept: algorithms the peer advertised, comma separated, None
+                   if the peer is expected to support the configured one
+    :return: body and the name of the algorithm, None if not compressed
+    """
+    min_bytes = CONF.rpc.compress_min_bytes
+    if not min_bytes or len(body) < min_bytes:
+        return body, None
+    algorithm = CONF.rpc.compress_algorithm
+    if accept is not None and algorithm not in accept.split(','):
+        return body, None
+    return COMPRESSIONS[algorithm].compress(body), algorithm
+
+
+def decompress(body, algorithm):
+    if not algorithm:
+        return body
+    try:
+        return COMPRESSIONS[algorithm].decompress(body)
+    except KeyError:
+        raise exceptions.DAOException('Unsupported compression: {0}'.
+                                      format(algorithm))
+
+
+# Keys of a request which hold its payload, see pack_frames
+PAYLOAD_KEYS = ('args', 'kwargs')
+
+
+def extract_buffers(data, min_bytes):
+    """Take binary values of at least `min_bytes` out of `data`.
+
+    Binary values are bytearray, buffer and memoryview objects. Byte
+    strings are left in place, since text is str as well in Python 2.
+    Transports send the values apart from the body, each one is replaced
+    by a {'__frame__': index} placeholder. Lists, tuples and dicts are
+    walked.
+    :return: data with placeholders and the list of binary values
+    """
+    buffers = []
+
+    def walk(obj):
+        if isinstance(obj, (bytearray, buffer, memoryview)):
+            if len(obj) < min_bytes:
+                return obj
+            buffers.append(obj)
+            return {'__frame__': len(buffers) - 1}
+        if isinstance(obj, dict):
+            return dict((key, walk(value)) for key, value in obj.items())
+        if isinstance(obj, list):
+            return [walk(value) for value in obj]
+        if isinstance(obj, tuple):
+            return tuple(walk(value) for value in obj)
+        return obj
+
+    return walk(data), buffers
+
+
+def insert_buffers(data, buffers):
+    """Put `buffers` back in place of the placeholders of `data`"""
+    def walk(obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and '__frame__' in obj:
+                return buffers[obj['__frame__']]
+            return dict((key, walk(value)) for key, value in obj.items())
+        if isinstance(obj, list):
+            return [walk(value) for value in obj]
+        if isinstance(obj, tuple):
+            return tuple(walk(value) for value in obj)
+        return obj
+
+    return walk(data)
+
+
+def pack_frames(data, data_codec, accept=None, min_bytes=0, keys=None):
+    """Frames of `data` for multipart transports.
+
+    Content type, body and, if any, compression then binary values of at
+    least `min_bytes` split out of `data`, see extract_buffers, 0 splits
+    none. Values are split out of the `keys` of `data` only if given,
+    e.g. PAYLOAD_KEYS of requests. `accept` is as in compress.
+    """
+    buffers = []
+    if min_bytes and keys is None:
+        data, buffers = extract_buffers(data, min_bytes)
+    elif min_bytes:
+        values, buffers = extract_buffers([data[key] for key in keys],
+                                          min_bytes)
+        data = dict(data)
+        data.update(zip(keys, values))
+    body, compression = compress(data_codec.dumps(data), accept)
+    frames = [data_codec.content_type, body]
+    if compression is not None or buffers:
+        frames.append(compression or '')
+    return frames + buffers
+
+
+def unpack_frames(frames, default):
+    """Data of frames received with copy=False, see pack_frames.
+
+    `default` is the codec of legacy peers, as in for_content_type.
+    """
+    content_type, body = frames[0].bytes, frames[1].bytes
+    compression = frames[2].bytes if len(frames) > 2 else None
+    data_codec = for_content_type(content_type, default)
+    data = data_codec.loads(decompress(body, compression))
+    if len(frames) > 3:
+        data = insert_buffers(data, [frame.buffer for frame in frames[3:]])
+    return data
+
+
+def get_codec(default):
+    """Codec set by `[rpc] codec`, or the `default` one of the driver"""
+    name = CONF.rpc.codec or default
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise exceptions.DAOException('Codec is not available: {0}'.
+                                      format(name))
+
+
+def accepted_codecs(default):
+    """Names of the codecs messages may be decoded with"""
+    if CONF.rpc.accepted_codecs:
+        return [name.strip() for name in CONF.rpc.accepted_codecs.split(',')]
+    return [CONF.rpc.codec or default, default]
+
+
+def for_content_type(content_type, default):
+    """Codec to decode a message, `default` one for legacy peers"""
+    if not content_type:
+        data_codec = CODECS[default]
+    else:
+        try:
+            data_codec = CONTENT_TYPES[content_type]
+        except KeyError:
+            raise exceptions.DAOException('Unsupported content type: {0}'.
+                                          format(content_type))
+    if data_codec.name not in accepted_codecs(default):
+        raise exceptions.DAOException('Codec is not accepted: {0}'.
+                                      format(data_codec.name))
+    return data_codec
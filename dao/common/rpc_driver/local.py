@@ -0,0 +1,113 @@
+#
+# Copyright 2016 Symantec.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process driver for clients and servers living in the same process.
+
+Requests are put on a green queue of the server and replies are sent
+through a green queue of the call, nothing is serialized. Arguments and
+results are passed by reference, unless `[rpc] local_copy` is set, in
+which case they are deep copied the way a serializing driver would.
+
+Enable with `[rpc] driver = dao.common.rpc_driver.local`, e.g. for
+all-in-one deployments and tests.
+"""
+
+import copy
+import eventlet
+import uuid
+from eventlet import queue
+from dao.common import config
+from dao.common import exceptions
+from dao.common import log
+from dao.common.rpc_driver import base
+
+opts = [
+    config.BoolOpt('rpc', 'local_copy', default=False,
+                   help='Copy arguments and results of local RPC calls'),
+]
+config.register(opts)
+CONF = config.get_config()
+
+logger = log.getLogger(__name__)
+
+# Servers of the process by URL
+_servers = {}
+
+
+def _copy(data):
+    if CONF.rpc.local_copy:
+        return copy.deepcopy(data)
+    return data
+
+
+class Client(base.Client):
+    def _put(self, request):
+        server = _servers.get(self.connect_url)
+        if server is None:
+            raise exceptions.DAONotFound('Unable to connect to {0}'.
+                                         format(self.connect_url))
+        server.queue.put(request)
+
+    def call(self, func, *args, **kwargs):
+        logger.debug('Call sent: %s', func)
+        reply_to = queue.LightQueue()
+        self._put({'function': func,
+                   'args': _copy(args),
+                   'kwargs': _copy(kwargs),
+                   'reply_to': reply_to})
+        with eventlet.Timeout(self.timeout, exceptions.DAOTimeout):
+            return reply_to.get()
+
+    def call_stream(self, func, *args, **kwargs):
+        logger.debug('Stream call sent: %s', func)
+        reply_to = queue.LightQueue()
+        self._put({'function': func,
+                   'args': _copy(args),
+                   'kwargs': _copy(kwargs),
+                   'reply_to': reply_to,
+                   'stream': uuid.uuid4().hex})
+        return base.ordered_chunks(self._stream(reply_to))
+
+    def _stream(self, reply_to):
+        while True:
+            with eventlet.Timeout(self.timeout, exceptions.DAOTimeout):
+                chunk = reply_to.get()
+            yield chunk
+
+    def send(self, func, *args, **kwargs):
+        logger.debug('Send sent: %s', func)
+        self._put({'function': func,
+                   'args': _copy(args),
+                   'kwargs': _copy(kwargs)})
+
+
+class Server(base.Server):
+    def __init__(self, port):
+        super(Server, self).__init__(port)
+        self.queue = queue.LightQueue()
+        _servers[self.url] = self
+
+    def get_request(self):
+        return self.queue.get()
+
+    def get_requests(self, max_n):
+        requests = [self.queue.get()]
+        while len(requests) < max_n and not self.queue.empty():
+            requests.append(self.queue.get_nowait())
+        return requests
+
+    def send_reply(self, reply_to, data):
+        # Queue of a call which timed out is dropped with the reply
+        reply_to.put(_copy(data))
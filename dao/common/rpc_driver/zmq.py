@@ -14,58 +14,125 @@
 # under the License.
 
 import eventlet
+import heapq
 import time
 import traceback
+import uuid
 from eventlet.green import zmq
 from dao.common import config
 from dao.common import exceptions
 from dao.common import log
 from dao.common.rpc_driver import base
+from dao.common.rpc_driver import codec
 
 CONF = config.get_config()
 
 logger = log.getLogger(__name__)
 context = zmq.Context()
 
+# Codec of the peers which send bare single frame messages
+LEGACY_CODEC = 'pickle'
+
+
+def send(sock, data, data_codec, accept=None, split=False, keys=None):
+    """Send a message, see codec.pack_frames.
+
+    `split` tells whether the peer takes binary values in frames of their
+    own, which `[rpc] zmq_frame_min_bytes` enables.
+    """
+    min_bytes = CONF.rpc.zmq_frame_min_bytes if split else 0
+    frames = codec.pack_frames(data, data_codec, accept, min_bytes, keys)
+    if len(frames) == 2 and data_codec.name == LEGACY_CODEC:
+        # Same as send_pyobj, readable by any peer
+        sock.send(frames[1])
+    else:
+        # Large buffers go out without a copy
+        sock.send_multipart(frames, copy=len(frames) < 4)
+
+
+def recv(sock):
+    """Receive a message, returns data and its content type"""
+    frames = sock.recv_multipart(copy=False)
+    if len(frames) == 1:
+        data_codec = codec.for_content_type(None, LEGACY_CODEC)
+        return data_codec.loads(frames[0].bytes), None
+    return codec.unpack_frames(frames, LEGACY_CODEC), frames[0].bytes
+
+
+class SocketManager(object):
+    """Keeps track of ZMQ sockets and closes the finished ones.
+
+    Finished PUSH sockets are kept open for a while to let queued messages
+    go out. They wait in a heap ordered by close time, and a background
+    green thread closes them as they expire.
+    """
+
+    def __init__(self):
+        self.lingering = []
+        self.open = 0
+        self.closed = 0
+        self.reaper = None
+
+    def opened(self, socket):
+        self.open += 1
+
+    def linger(self, socket, delay):
+        heapq.heappush(self.lingering, (time.time() + delay,
+                                        socket.sock_id, socket))
+        if self.reaper is None:
+            self.reaper = eventlet.spawn(self._reap)
+
+    def close(self, socket):
+        socket.sock.close()
+        self.open -= 1
+        self.closed += 1
+        logger.debug('Close socket %s', socket.sock_id)
+
+    def stats(self):
+        return {'open': self.open,
+                'lingering': len(self.lingering),
+                'closed': self.closed}
+
+    def _reap(self):
+        try:
+            while self.lingering:
+                close_at = self.lingering[0][0]
+                current = time.time()
+                if close_at > current:
+                    eventlet.sleep(min(close_at - current, 1))
+                    continue
+                socket = heapq.heappop(self.lingering)[2]
+                try:
+                    self.close(socket)
+                except Exception:
+                    logger.warning(traceback.format_exc())
+        finally:
+            self.reaper = None
+
 
 class ZMQSocket(object):
 
-    sockets_pool = []
+    manager = SocketManager()
     cnt = 0
 
     def __init__(self, sock_type):
         self.sock_type = sock_type
         self.sock = None
-        self.finished = False
         self.sock_id = ZMQSocket.cnt
         ZMQSocket.cnt += 1
-        self.sockets_pool.append((time.time(), self))
-        self._clean_up()
 
     def __enter__(self):
         self.sock = context.socket(self.sock_type)
         self.sock.setsockopt(zmq.LINGER, CONF.rpc.send_timeout)
+        self.manager.opened(self)
         logger.debug('Socket entered: %s', self.sock_id)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.finished = True
-
-    @classmethod
-    def _clean_up(cls):
-        current = time.time()
-        logger.debug('CleanUp. Queue len: %s', len(cls.sockets_pool))
-        for sock_time, socket in cls.sockets_pool:
-            if socket.finished:
-                if socket.sock is None:
-                    cls.sockets_pool.remove((sock_time, socket))
-                else:
-                    close = (socket.sock_type == zmq.PULL or
-                             (current-sock_time) > CONF.rpc.send_timeout)
-                    if close:
-                        socket.sock.close()
-                        cls.sockets_pool.remove((sock_time, socket))
-                        logger.debug('Close socket %s', socket.sock_id)
+        if self.sock_type == zmq.PULL:
+            self.manager.close(self)
+        else:
+            self.manager.linger(self, CONF.rpc.send_timeout)
 
     def connect(self, connect_url):
         self.sock.connect(connect_url)
@@ -76,34 +143,65 @@ class ZMQSocket(object):
         reply_port = self.sock.bind_to_random_port(bind_url)
         return base.build_url(CONF.rpc.ip, reply_port)
 
-    def recv_pyobj(self, timeout=None):
+    def send(self, data, data_codec, accept=None, split=False, keys=None):
+        send(self.sock, data, data_codec, accept, split, keys)
+
+    def recv(self, timeout=None):
         if timeout is None:
-            return self.sock.recv_pyobj()
+            return recv(self.sock)[0]
         else:
             with eventlet.timeout.Timeout(timeout, exceptions.DAOTimeout):
-                return self.sock.recv_pyobj()
+                return recv(self.sock)[0]
 
 
 class Client(base.Client):
+    def __init__(self, connect_url=None, ip=None, port=None, timeout=None):
+        super(Client, self).__init__(connect_url, ip, port, timeout)
+        self.codec = codec.get_codec(LEGACY_CODEC)
+
     def call(self, func, *args, **kwargs):
         logger.info('Call sent: %s', func)
         with ZMQSocket(zmq.PUSH) as push:
             with ZMQSocket(zmq.PULL) as pull:
                 push.connect(self.connect_url)
                 reply_url = pull.bind_random()
-                push.sock.send_pyobj({'reply_to': reply_url,
-                                      'function': func,
-                                      'args': args,
-                                      'kwargs': kwargs})
-                return pull.recv_pyobj(self.timeout)
+                push.send({'reply_to': reply_url,
+                           'function': func,
+                           'args': args,
+                           'kwargs': kwargs,
+                           'accept_compression': codec.ACCEPT_COMPRESSION,
+                           'accept_frames': True},
+                          self.codec, split=True, keys=codec.PAYLOAD_KEYS)
+                return pull.recv(self.timeout)
+
+    def call_stream(self, func, *args, **kwargs):
+        logger.info('Stream call sent: %s', func)
+        return base.ordered_chunks(self._stream(func, args, kwargs))
+
+    def _stream(self, func, args, kwargs):
+        with ZMQSocket(zmq.PUSH) as push:
+            with ZMQSocket(zmq.PULL) as pull:
+                push.connect(self.connect_url)
+                reply_url = pull.bind_random()
+                push.send({'reply_to': reply_url,
+                           'function': func,
+                           'args': args,
+                           'kwargs': kwargs,
+                           'stream': uuid.uuid4().hex,
+                           'accept_compression': codec.ACCEPT_COMPRESSION,
+                           'accept_frames': True},
+                          self.codec, split=True, keys=codec.PAYLOAD_KEYS)
+                while True:
+                    yield pull.recv(self.timeout)
 
     def send(self, func, *args, **kwargs):
         with ZMQSocket(zmq.PUSH) as push:
             push.connect(self.connect_url)
             logger.info('Send sent: %s', func)
-            push.sock.send_pyobj({'function': func,
-                                  'args': args,
-                                  'kwargs': kwargs})
+            push.send({'function': func,
+                       'args': args,
+                       'kwargs': kwargs},
+                      self.codec, split=True, keys=codec.PAYLOAD_KEYS)
 
 
 class Server(base.Server):
@@ -113,9 +211,20 @@ class Server(base.Server):
         self.socket.bind(self.url)
 
     def get_request(self):
-        return self.socket.recv_pyobj()
+        request, content_type = recv(self.socket)
+        accept = request.pop('accept_compression', '')
+        split = request.pop('accept_frames', False)
+        if request.get('reply_to') is not None:
+            # Reply is encoded with the codec of the request, compressed
+            # and split only if its sender supports it
+            request['reply_to'] = (request['reply_to'], content_type,
+                                   accept, split)
+        return request
 
     def send_reply(self, reply_to, data):
+        reply_to, content_type, accept, split = reply_to
         with ZMQSocket(zmq.PUSH) as socket:
             socket.connect(reply_to)
-            socket.sock.send_pyobj(data)
+            socket.send(data, codec.for_content_type(content_type,
+                                                     LEGACY_CODEC),
+                        accept, split)
@@ -0,0 +1,187 @@
+#
+# Copyright 2016 Symantec.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""ZMQ driver multiplexing calls over persistent DEALER/ROUTER sockets.
+
+Clients keep a single DEALER socket per server URL which is shared by all
+the calls to that server. Every request is tagged with an id, the server
+ROUTER socket sends the reply back over the same connection and the reply
+is handed to the waiting call by that id.
+
+Enable with `[rpc] driver = dao.common.rpc_driver.zmq_router`, on both
+clients and servers.
+"""
+
+import eventlet
+import itertools
+import traceback
+import uuid
+from eventlet import event
+from eventlet import queue
+from eventlet.green import zmq
+from dao.common import config
+from dao.common import exceptions
+from dao.common import log
+from dao.common.rpc_driver import base
+from dao.common.rpc_driver import codec
+
+CONF = config.get_config()
+
+logger = log.getLogger(__name__)
+context = zmq.Context()
+
+DEFAULT_CODEC = 'pickle'
+
+
+def send(sock, envelope, data, data_codec, accept=None, split=False,
+         keys=None):
+    """Send `data` after the `envelope` frames, see zmq.send"""
+    min_bytes = CONF.rpc.zmq_frame_min_bytes if split else 0
+    frames = codec.pack_frames(data, data_codec, accept, min_bytes, keys)
+    # Large buffers go out without a copy
+    sock.send_multipart(envelope + frames, copy=len(frames) < 4)
+
+
+class Connection(object):
+    """DEALER socket connected to a single server"""
+
+    def __init__(self, url):
+        self.url = url
+        self.waiters = {}
+        self.ids = itertools.count()
+        self.sock = context.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.LINGER, CONF.rpc.send_timeout)
+        self.sock.connect(url)
+        logger.info('Connection url: %s', url)
+        eventlet.spawn_n(self._receive)
+
+    def send(self, data, data_codec):
+        # Empty request id tells the server no reply is expected
+        send(self.sock, [''], data, data_codec, split=True,
+             keys=codec.PAYLOAD_KEYS)
+
+    def call(self, data, data_codec, timeout):
+        request_id = str(next(self.ids))
+        waiter = self.waiters[request_id] = event.Event()
+        try:
+            send(self.sock, [request_id], data, data_codec, split=True,
+                 keys=codec.PAYLOAD_KEYS)
+            with eventlet.timeout.Timeout(timeout, exceptions.DAOTimeout):
+                return waiter.wait()
+        finally:
+            self.waiters.pop(request_id, None)
+
+    def stream(self, data, data_codec, timeout):
+        request_id = str(next(self.ids))
+        waiter = self.waiters[request_id] = queue.LightQueue()
+        try:
+            send(self.sock, [request_id], data, data_codec, split=True,
+                 keys=codec.PAYLOAD_KEYS)
+            while True:
+                with eventlet.timeout.Timeout(timeout, exceptions.DAOTimeout):
+                    chunk = waiter.get()
+                yield chunk
+        finally:
+            self.waiters.pop(request_id, None)
+
+    def _receive(self):
+        while True:
+            try:
+                frames = self.sock.recv_multipart(copy=False)
+                request_id = frames[0].bytes
+                waiter = self.waiters.get(request_id)
+                if waiter is None:
+                    logger.info('Drop reply for expired call %s', request_id)
+                    continue
+                data = codec.unpack_frames(frames[1:], DEFAULT_CODEC)
+                if isinstance(waiter, queue.LightQueue):
+                    # Streamed call, the caller forgets it at the end
+                    waiter.put(data)
+                else:
+                    del self.waiters[request_id]
+                    waiter.send(data)
+            except Exception:
+                logger.warning(traceback.format_exc())
+
+
+_connections = {}
+
+
+def get_connection(url):
+    connection = _connections.get(url)
+    if connection is None:
+        connection = _connections[url] = Connection(url)
+    return connection
+
+
+class Client(base.Client):
+    def __init__(self, connect_url=None, ip=None, port=None, timeout=None):
+        super(Client, self).__init__(connect_url, ip, port, timeout)
+        self.codec = codec.get_codec(DEFAULT_CODEC)
+
+    def call(self, func, *args, **kwargs):
+        logger.info('Call sent: %s', func)
+        connection = get_connection(self.connect_url)
+        return connection.call({'function': func,
+                                'args': args,
+                                'kwargs': kwargs,
+                                'accept_compression':
+                                    codec.ACCEPT_COMPRESSION,
+                                'accept_frames': True},
+                               self.codec, self.timeout)
+
+    def call_stream(self, func, *args, **kwargs):
+        logger.info('Stream call sent: %s', func)
+        connection = get_connection(self.connect_url)
+        return base.ordered_chunks(connection.stream(
+            {'function': func,
+             'args': args,
+             'kwargs': kwargs,
+             'stream': uuid.uuid4().hex,
+             'accept_compression': codec.ACCEPT_COMPRESSION,
+             'accept_frames': True},
+            self.codec, self.timeout))
+
+    def send(self, func, *args, **kwargs):
+        logger.info('Send sent: %s', func)
+        get_connection(self.connect_url).send({'function': func,
+                                               'args': args,
+                                               'kwargs': kwargs}, self.codec)
+
+
+class Server(base.Server):
+    def __init__(self, port):
+        super(Server, self).__init__(port)
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.bind(self.url)
+
+    def get_request(self):
+        frames = self.socket.recv_multipart(copy=False)
+        identity, request_id, content_type = [f.bytes for f in frames[:3]]
+        request = codec.unpack_frames(frames[2:], DEFAULT_CODEC)
+        accept = request.pop('accept_compression', '')
+        split = request.pop('accept_frames', False)
+        if request_id:
+            # Reply is encoded with the codec of the request, compressed
+            # and split only if its sender supports it
+            request['reply_to'] = (identity, request_id, content_type,
+                                   accept, split)
+        return request
+
+    def send_reply(self, reply_to, data):
+        identity, request_id, content_type, accept, split = reply_to
+        data_codec = codec.for_content_type(content_type, DEFAULT_CODEC)
+        send(self.socket, [identity, request_id], data, data_codec,
+             accept, split)
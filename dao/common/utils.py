@@ -13,12 +13,22 @@
 # under the License.
 
 import collections
+import contextlib
+import eventlet
 import functools
+import os
+import random
+import signal
+import sys
 import time
+import traceback
 import yaml
+from eventlet import event
+from eventlet import queue
 from eventlet import timeout
 from eventlet import semaphore
 from eventlet.green import subprocess
+from dao.common import cache
 from dao.common import log
 from dao.common import exceptions
 
@@ -48,10 +58,55 @@ class Popen(subprocess.Popen):
         self.wait()
 
 
-def run_sh(args):
+def _kill(p, group):
+    try:
+        if group:
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except OSError:
+        # Already gone
+        pass
+
+
+@contextlib.contextmanager
+def _deadline(p, timeout, args):
+    """Kill process group of `p` and raise DAOTimeout after `timeout`"""
+    if timeout is None:
+        yield
+        return
+    expired = []
+
+    def kill():
+        expired.append(True)
+        logger.info('Kill cmd after %ss: %s', timeout, ' '.join(args))
+        _kill(p, True)
+
+    timer = eventlet.spawn_after(timeout, kill)
+    try:
+        yield
+    except Exception:
+        if not expired:
+            raise
+    finally:
+        timer.cancel()
+    if expired:
+        raise exceptions.DAOTimeout('Command timed out after {0}s: {1}'.
+                                    format(timeout, ' '.join(args)))
+
+
+def _new_session(timeout):
+    # Commands which may time out get a process group of their own, so
+    # that the processes they spawn are killed with them
+    return os.setsid if timeout is not None else None
+
+
+def run_sh(args, timeout=None, env=None):
     logger.debug('Run cmd: %s', ' '.join(args))
-    with Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
-        stdout, stderr = p.communicate()
+    with Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+               preexec_fn=_new_session(timeout), env=env) as p:
+        with _deadline(p, timeout, args):
+            stdout, stderr = p.communicate()
         if p.returncode == 0:
             return stdout
         else:
@@ -60,6 +115,115 @@ def run_sh(args):
             raise exceptions.DAOExecError(p.returncode, stdout, stderr)
 
 
+def _read_lines(f, lines):
+    for line in iter(f.readline, ''):
+        lines.append(line)
+
+
+def run_sh_stream(args, timeout=None, tail=100):
+    """Run a command, yield lines of its output as they come.
+
+    Output is not kept, but the last `tail` lines of stdout and stderr,
+    which DAOExecError carries if the command fails. A command running
+    longer than `timeout` seconds is killed with its process group and
+    DAOTimeout is raised.
+    """
+    logger.debug('Run cmd: %s', ' '.join(args))
+    stdout = collections.deque(maxlen=tail)
+    stderr = collections.deque(maxlen=tail)
+    with Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+               preexec_fn=_new_session(timeout)) as p:
+        reader = eventlet.spawn(_read_lines, p.stderr, stderr)
+        try:
+            with _deadline(p, timeout, args):
+                for line in iter(p.stdout.readline, ''):
+                    stdout.append(line)
+                    yield line
+                reader.wait()
+                p.wait()
+        finally:
+            if p.poll() is None:
+                # Caller stopped reading the output
+                _kill(p, timeout is not None)
+            reader.kill()
+    if p.returncode != 0:
+        stderr = ''.join(stderr)
+        logger.info('Ret code: {0}, msg: {1}'.format(p.returncode, stderr))
+        raise exceptions.DAOExecError(p.returncode, ''.join(stdout), stderr)
+
+
+CommandResult = collections.namedtuple('CommandResult',
+                                       'args stdout error duration')
+
+
+class RunMany(object):
+    """Commands run concurrently, iterating gives results as they complete.
+
+    Results are CommandResult tuples, `error` is the exception raised by
+    run_sh, e.g. DAOExecError or DAOTimeout, None on success.
+    """
+
+    def __init__(self, commands, concurrency=10, timeout=None):
+        self.commands = list(commands)
+        self.timeout = timeout
+        self.pool = eventlet.GreenPool(concurrency)
+        self.queue = queue.LightQueue()
+        self.results = []
+        self.started = time.time()
+        self.finished = None
+        eventlet.spawn_n(self._spawn_all)
+
+    def _spawn_all(self):
+        for args in self.commands:
+            self.pool.spawn_n(self._run, args)
+
+    def _run(self, args):
+        start = time.time()
+        stdout, error = None, None
+        try:
+            stdout = run_sh(args, self.timeout)
+        except Exception, exc:
+            error = exc
+        self.queue.put(CommandResult(args, stdout, error,
+                                     time.time() - start))
+
+    def __iter__(self):
+        while len(self.results) < len(self.commands):
+            result = self.queue.get()
+            self.results.append(result)
+            if len(self.results) == len(self.commands):
+                self.finished = time.time()
+            yield result
+
+    def wait(self):
+        """Wait for all the commands, return their results"""
+        for _ in self:
+            pass
+        return self.results
+
+    def stats(self, slowest=5):
+        """Timing of the commands completed so far"""
+        durations = [result.duration for result in self.results]
+        ranked = sorted(self.results, key=lambda result: -result.duration)
+        return {'completed': len(self.results),
+                'failed': sum(1 for result in self.results if result.error),
+                'wall': (self.finished or time.time()) - self.started,
+                'total': sum(durations),
+                'max': max(durations) if durations else None,
+                'slowest': [(' '.join(result.args), result.duration)
+                            for result in ranked[:slowest]]}
+
+
+def run_many(commands, concurrency=10, timeout=None):
+    """Run `commands` with at most `concurrency` at a time.
+
+    :param commands: list of args lists, as taken by run_sh
+    :param timeout: seconds each command may run, see run_sh
+    :rtype: RunMany
+    """
+    return RunMany(commands, concurrency, timeout)
+
+
 class Timed(timeout.Timeout):
     def __init__(self, time):
         super(Timed, self).__init__(time, exceptions.DAOTimeout)
@@ -84,41 +248,163 @@ class Synchronized(object):
 
 
 class CacheIt(object):
-    """ Memoize With Timeout and eventlet sync"""
+    """ Memoize With Timeout and eventlet sync
+
+    Hits of the default, in-memory, backend take no locks. Concurrent
+    misses of the same key share a single call of the function, misses of
+    different keys run in parallel. The call runs in a green thread of its
+    own, so a caller timing out does not fail the others.
+
+    At most `maxsize` results are kept per function, the least recently
+    used ones are evicted first. Expired results are purged once per
+    `timeout`. Hits, misses and evictions are counted, see `stats`.
+
+    With `grace` set, a result expired less than `grace` seconds ago is
+    still returned while a green thread refreshes it in the background.
+    `jitter` shortens the timeout of every result by a random fraction up
+    to its value, so results cached together do not expire together.
 
-    def __init__(self, timeout=None, ignore_self=True):
+    Results are kept in memory of the process unless another `backend`
+    is given, e.g. `cache.shared()` to share them between processes.
+    """
+
+    def __init__(self, timeout=None, ignore_self=True, maxsize=None,
+                 grace=None, jitter=0, backend=None):
         self.timeout = timeout
         self.ignore_self = ignore_self
-        self.cache = collections.defaultdict(dict)
+        self.grace = grace or 0
+        self.jitter = jitter
+        self.backend = backend or cache.MemoryBackend(maxsize)
+        self.functions = []
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+        self.purged_at = time.time()
 
     def _key_from_args(self, args, kwargs):
         key_args = args
         if self.ignore_self:
             key_args = key_args[1:]
-        return yaml.dump((key_args, tuple(sorted(kwargs.items()))))
+        kwargs_items = tuple(sorted(kwargs.items()))
+        key = (key_args, kwargs_items)
+        try:
+            hash(key)
+        except TypeError:
+            # Lists, dicts etc. among arguments
+            return yaml.dump(key)
+        # Equal arguments of different types, e.g. 1, 1.0 and True, get
+        # results of their own, as they do with YAML keys. Values nested in
+        # tuples are compared by equality only.
+        return key + (tuple(type(arg) for arg in key_args),
+                      tuple(type(value) for _, value in kwargs_items))
+
+    def _expires(self):
+        if self.timeout is None:
+            return None
+        return time.time() + self.timeout * (1 - random.random() * self.jitter)
+
+    @staticmethod
+    def _expired(v, current, grace=0):
+        return v[1] is not None and current > v[1] + grace
+
+    def _purge(self):
+        current = time.time()
+        if self.timeout is not None and \
+           (current - self.purged_at) > self.timeout:
+            self.purged_at = current
+            self.evictions += self.backend.purge(self.functions,
+                                                 current - self.grace)
 
     def evict(self, *args, **kwargs):
         key = self._key_from_args(args, kwargs)
-        if key in self.cache:
-            del self.cache[key]
+        for f in self.functions:
+            self.backend.delete(f, key)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'size': self.backend.size(self.functions)}
 
     def __call__(self, f):
-        cache = self.cache[f]
+        backend = self.backend
+        self.functions.append(f)
+        # Calls in progress, concurrent misses of a key wait for the first
+        calls = {}
+
+        def load(key, args, kwargs):
+            call = calls.get(key)
+            if call is None:
+                logger.debug('Create new key for %s: %s', f.__name__, key)
+                call = calls[key] = event.Event()
+                eventlet.spawn_n(run, call, key, args, kwargs)
+            return call.wait()
+
+        def run(call, key, args, kwargs):
+            # Green thread of its own, callers timing out or killed while
+            # waiting for the result leave it to the others
+            try:
+                result = f(*args, **kwargs)
+                self.evictions += backend.set(f, key,
+                                              (result, self._expires()))
+            except BaseException:
+                del calls[key]
+                call.send_exception(*sys.exc_info())
+                return
+            del calls[key]
+            self._purge()
+            call.send(result)
+
+        def refresh(key, args, kwargs):
+            if key in calls:
+                return
+            self.refreshes += 1
+            try:
+                load(key, args, kwargs)
+            except Exception:
+                logger.warning('Refresh of %s failed: %s', f.__name__,
+                               traceback.format_exc())
 
-        @Synchronized(f)
         @functools.wraps(f)
         def func(*args, **kwargs):
             key = self._key_from_args(args, kwargs)
-            try:
-                v = cache[key]
-                if self.timeout is not None and \
-                   (time.time() - v[1]) > self.timeout:
-                    raise KeyError
-            except KeyError:
-                logger.debug('Create new key for %s: %s', f.__name__, key)
-                v = cache[key] = f(*args, **kwargs), time.time()
-            return v[0]
+            v = backend.get(f, key)
+            if v is not None:
+                current = time.time()
+                if not self._expired(v, current, self.grace):
+                    self.hits += 1
+                    if self._expired(v, current) and key not in calls:
+                        eventlet.spawn_n(refresh, key, args, kwargs)
+                    return v[0]
+            if key in calls:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return load(key, args, kwargs)
 
         func.cache = self
 
         return func
+
+
+# run_sh wrappers by TTL of their results, see run_sh_shared
+_shared_runs = {}
+
+
+def run_sh_shared(args, ttl=0, timeout=None, env=None):
+    """run_sh for read-only commands, e.g. lsblk or ip addr.
+
+    Concurrent calls with the same `args`, `env` and `timeout` share a
+    single run of the command. Its output is also returned to identical
+    calls made within `ttl` seconds, failures are not kept.
+    """
+    run = _shared_runs.get(ttl)
+    if run is None:
+        @CacheIt(timeout=ttl, ignore_self=False, maxsize=1000)
+        def run(args, env, timeout):
+            return run_sh(list(args), timeout, env and dict(env))
+        _shared_runs[ttl] = run
+    # Hashable key, unhashable ones take a slower path in CacheIt
+    return run(tuple(args), env and tuple(sorted(env.items())), timeout)
@@ -24,5 +24,8 @@ setuptools.setup(
         'Popen',
         'amqpy'
     ],
+    extras_require={
+        'msgpack': ['msgpack'],
+    },
     tests_require=['pytest'],
 )